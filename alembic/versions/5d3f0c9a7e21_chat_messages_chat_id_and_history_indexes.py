@@ -0,0 +1,88 @@
+"""chat_messages: chat_id and history indexes
+
+Revision ID: 5d3f0c9a7e21
+Revises: 887bf0de3cbb
+Create Date: 2026-10-18 12:00:00.000000
+
+Миграция рассчитана на работающую таблицу: колонка добавляется без значения по
+умолчанию, внешний ключ создается NOT VALID и проверяется после заполнения,
+chat_id заполняется пакетами по BACKFILL_BATCH_SIZE строк (каждый пакет -
+отдельная транзакция), индексы строятся CONCURRENTLY.
+"""
+from typing import Sequence, Union
+from uuid import UUID
+
+import sqlalchemy as sa
+import sqlalchemy_utils
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '5d3f0c9a7e21'
+down_revision: Union[str, None] = '887bf0de3cbb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL_BATCH_SIZE = 10_000
+
+
+def upgrade() -> None:
+    op.add_column(
+        'chat_messages',
+        sa.Column('chat_id', sqlalchemy_utils.types.uuid.UUIDType(binary=False), nullable=True),
+        schema='public',
+    )
+    op.execute(
+        'ALTER TABLE public.chat_messages ADD CONSTRAINT fk_chat_messages_chat_id_chats '
+        'FOREIGN KEY (chat_id) REFERENCES public.chats (id) ON DELETE CASCADE NOT VALID'
+    )
+
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        # Проход по первичному ключу: каждый пакет читает следующий диапазон id, а не ищет NULL заново
+        backfill = sa.text(
+            'WITH batch AS ('
+            '  SELECT id FROM public.chat_messages WHERE id > :last_id ORDER BY id LIMIT :batch_size'
+            '), updated AS ('
+            '  UPDATE public.chat_messages AS m SET chat_id = c.id '
+            '  FROM batch, public.chats AS c '
+            '  WHERE m.id = batch.id AND c.name = m.channel AND m.chat_id IS NULL'
+            ') '
+            'SELECT id FROM batch ORDER BY id DESC LIMIT 1'
+        )
+        last_id = UUID(int=0)
+        if op.get_context().as_sql:
+            # В режиме --sql пакеты недоступны: заполнение одним запросом
+            op.execute(
+                'UPDATE public.chat_messages AS m SET chat_id = c.id FROM public.chats AS c '
+                'WHERE c.name = m.channel AND m.chat_id IS NULL'
+            )
+            last_id = None
+        while last_id is not None:
+            last_id = connection.execute(backfill, {'last_id': last_id, 'batch_size': BACKFILL_BATCH_SIZE}).scalar()
+
+        op.execute('ALTER TABLE public.chat_messages VALIDATE CONSTRAINT fk_chat_messages_chat_id_chats')
+        op.create_index(
+            'ix_public_chat_messages_channel_sequence_number', 'chat_messages',
+            ['channel', 'sequence_number', 'id'], unique=False, schema='public',
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+        op.create_index(
+            'ix_public_chat_messages_chat_id_sequence_number', 'chat_messages',
+            ['chat_id', 'sequence_number', 'id'], unique=False, schema='public',
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_public_chat_messages_chat_id_sequence_number', table_name='chat_messages', schema='public',
+            postgresql_concurrently=True, if_exists=True,
+        )
+        op.drop_index(
+            'ix_public_chat_messages_channel_sequence_number', table_name='chat_messages', schema='public',
+            postgresql_concurrently=True, if_exists=True,
+        )
+    op.drop_constraint('fk_chat_messages_chat_id_chats', 'chat_messages', schema='public', type_='foreignkey')
+    op.drop_column('chat_messages', 'chat_id', schema='public')
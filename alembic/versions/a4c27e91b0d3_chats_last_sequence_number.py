@@ -0,0 +1,41 @@
+"""chats: last_sequence_number counter
+
+Revision ID: a4c27e91b0d3
+Revises: 5d3f0c9a7e21
+Create Date: 2026-10-18 15:00:00.000000
+
+Номера сообщений выдает счетчик чата в БД (UPDATE ... RETURNING) вместо
+счетчиков процессов. Колонка добавляется со значением по умолчанию (без
+перезаписи таблицы) и заполняется последним сохраненным номером канала.
+Сообщения, еще не записанные из очередей к моменту миграции, в этот номер не
+попадают: миграцию запускают после остановки веб-процессов и записи очередей.
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'a4c27e91b0d3'
+down_revision: Union[str, None] = '5d3f0c9a7e21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        'chats',
+        sa.Column('last_sequence_number', sa.Integer(), nullable=False, server_default='0'),
+        schema='public',
+    )
+    op.execute(
+        'UPDATE public.chats AS c SET last_sequence_number = m.last_sequence_number '
+        'FROM (SELECT channel, max(sequence_number) AS last_sequence_number '
+        '      FROM public.chat_messages GROUP BY channel) AS m '
+        'WHERE m.channel = c.name'
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('chats', 'last_sequence_number', schema='public')
@@ -0,0 +1,43 @@
+"""chat_messages: channel length matches the chat name limit
+
+Revision ID: c81f4d2e6a57
+Revises: a4c27e91b0d3
+Create Date: 2026-10-18 18:00:00.000000
+
+Имя канала в сообщениях ограничено так же, как имя чата в API (100 символов),
+иначе чаты с именами длиннее 50 нельзя записать в историю. Больше 100 не
+допускается: очередь {name}_messages и ключ маршрутизации должны уложиться в
+255 байт брокера и для кириллицы. Расширение varchar в PostgreSQL меняет только
+каталог, без перезаписи таблицы и индексов.
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c81f4d2e6a57'
+down_revision: Union[str, None] = 'a4c27e91b0d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.alter_column(
+        'chat_messages', 'channel',
+        existing_type=sa.String(length=50),
+        type_=sa.String(length=100),
+        existing_nullable=False,
+        schema='public',
+    )
+
+
+def downgrade() -> None:
+    op.alter_column(
+        'chat_messages', 'channel',
+        existing_type=sa.String(length=100),
+        type_=sa.String(length=50),
+        existing_nullable=False,
+        schema='public',
+    )
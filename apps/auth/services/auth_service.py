@@ -81,3 +81,7 @@ class TokenService:
 
 def get_token_service(session: AsyncSession = Depends(get_session)) -> TokenService:
     return TokenService(session=session)
+
+def get_websocket_token_service() -> TokenService:
+    """Сервис токенов без сессии БД: проверка access-токена к базе не обращается"""
+    return TokenService(session=None)
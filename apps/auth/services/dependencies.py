@@ -2,7 +2,8 @@ from uuid import UUID
 
 from fastapi import Depends, HTTPException, Request, WebSocket, status
 
-from .auth_service import TokenService, get_token_service
+from .auth_service import (TokenService, get_token_service,
+                           get_websocket_token_service)
 
 async def get_refresh_token(request: Request, service: TokenService = Depends()):
     """Получение refresh-токена"""
@@ -23,7 +24,7 @@ async def get_refresh_token(request: Request, service: TokenService = Depends())
             detail="Refresh token истек или недействителен"
         )
     
-async def get_current_user_from_websocket(websocket: WebSocket, service: TokenService = Depends(get_token_service)) -> UUID:
+async def get_current_user_from_websocket(websocket: WebSocket, service: TokenService = Depends(get_websocket_token_service)) -> UUID:
     """Получение юзера из токена в заголовке вебсокета"""
     token = websocket.headers.get("Authorization")
     if not token:
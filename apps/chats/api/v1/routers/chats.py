@@ -1,17 +1,18 @@
 import logging
-from datetime import datetime, timezone
-from typing import List
+from typing import Optional
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
-from apps.chats.models.chats import ChatInDB, ChatMessageInDB, UserChatLink
+from apps.chats.models.chats import ChatInDB, UserChatLink
+from apps.chats.schemas.chats import ChatHistoryPage
+from apps.chats.services.history import get_history_page, parse_cursor
+from apps.chats.services.membership import membership_cache
 from apps.core.config import settings
 from apps.db import get_session
-from apps.mq.consumer import message_buffer
 from apps.users.models.users import UserInDB
 
 logger = logging.getLogger(__name__)
@@ -25,33 +26,30 @@ setattr(router, 'service_name', 'chats')
 
 @router.get(
     path="/{channel_name}/history",
-    response_model=List[ChatMessageInDB],
+    response_model=ChatHistoryPage,
     status_code=status.HTTP_200_OK,
     tags=["Чат"],
     summary="Получить историю сообщений чата",
     operation_id="get_chat_history",
 )
-async def get_chat_history(channel_name: str, session: AsyncSession = Depends(get_session)):
+async def get_chat_history(
+    channel_name: str,
+    before: Optional[str] = Query(None, description="Курсор: сообщения старше него"),
+    after: Optional[str] = Query(None, description="Курсор: сообщения новее него"),
+    limit: int = Query(
+        settings.chats_settings.history_page_size, ge=1, le=settings.chats_settings.history_max_page_size
+    ),
+    session: AsyncSession = Depends(get_session),
+):
+    """Без курсоров возвращаются последние limit сообщений"""
+    try:
+        before_cursor = parse_cursor(before) if before is not None else None
+        after_cursor = parse_cursor(after) if after is not None else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор")
+
     try:
-        stmt = select(ChatMessageInDB).filter(ChatMessageInDB.channel == channel_name).order_by(ChatMessageInDB.sequence_number)
-        result = await session.execute(stmt)
-        history = result.scalars().all()
-
-        for msg in message_buffer:
-            if msg["channel"] == channel_name:
-                history.append(ChatMessageInDB(
-                    action=msg["action"],
-                    username=msg["username"],
-                    channel=msg["channel"],
-                    time=datetime.fromisoformat(msg["time"]).replace(tzinfo=timezone.utc),
-                    sequence_number=msg["sequence_number"],
-                    message=msg.get("message") or "Сообщение отсутствует",
-                    created_at=datetime.now(timezone.utc).isoformat(),
-                    updated_at=datetime.now(timezone.utc).isoformat()
-                ))
-
-        history.sort(key=lambda x: x.sequence_number)
-        return history
+        return await get_history_page(session, channel_name, limit, before=before_cursor, after=after_cursor)
 
     except Exception as e:
         logger.error(f"Ошибка при получении истории чата: {e}")
@@ -101,6 +99,7 @@ async def add_user_to_chat(
         user_chat_link = UserChatLink(user_id=user.id, chat_id=chat.id)
         session.add(user_chat_link)
         await session.commit()
+        membership_cache.set_member(user.id, chat.id)
         return {"detail": f"Пользователь {username} добавлен в чат {channel_name}"}
 
     except IntegrityError:
@@ -1,8 +1,8 @@
 from datetime import datetime, timezone
-from typing import List
+from typing import List, Optional
 from uuid import UUID, uuid4
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy_utils import UUIDType
 from sqlmodel import Field, Relationship, SQLModel
 
@@ -41,13 +41,20 @@ class ChatInDB(SQLModel, table=True):
 
     id: UUID = Field(default_factory=uuid4, sa_column=Column(UUIDType(binary=False), nullable=False, primary_key=True, index=True))
     name: str = Field(sa_column=Column(String(255), nullable=False, unique=True)) 
+    # Последний выданный номер сообщения канала: единый счетчик для всех процессов
+    last_sequence_number: int = Field(default=0, sa_column=Column(Integer, nullable=False, server_default="0"))
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_column=Column(DateTime(timezone=True), nullable=False, default=datetime.now(timezone.utc)))
     users: List["UserInDB"] = Relationship(back_populates="chats", link_model=UserChatLink)
 
 class ChatMessageInDB(SQLModel, table=True):
     """Модель сообщения в чате, соответствующая структуре RabbitMQ."""
     __tablename__ = 'chat_messages'
-    __table_args__ = {'schema': metadata.schema}
+    __table_args__ = (
+        # Порядок колонок совпадает с курсором истории (sequence_number, id)
+        Index("ix_public_chat_messages_channel_sequence_number", "channel", "sequence_number", "id"),
+        Index("ix_public_chat_messages_chat_id_sequence_number", "chat_id", "sequence_number", "id"),
+        {'schema': metadata.schema},
+    )
 
     id: UUID = Field(
         default_factory=uuid4,
@@ -60,7 +67,15 @@ class ChatMessageInDB(SQLModel, table=True):
         sa_column=Column(String(50), nullable=False),
     )
     channel: str = Field(
-        sa_column=Column(String(50), nullable=False),
+        sa_column=Column(String(100), nullable=False),
+    )
+    chat_id: Optional[UUID] = Field(
+        default=None,
+        sa_column=Column(
+            UUIDType(binary=False),
+            ForeignKey(f"{metadata.schema}.chats.id", ondelete="CASCADE"),
+            nullable=True,
+        ),
     )
     time: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
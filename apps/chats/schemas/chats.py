@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import List, Optional
 from uuid import UUID
 
 from pydantic import BaseModel, Field
@@ -36,7 +37,7 @@ class ChatMessageHistory(BaseModel):
     )
     channel: str = Field(
         ..., 
-        max_length=50, 
+        max_length=100, 
         description="Канал, в котором было отправлено сообщение"
     )
     time: datetime = Field(
@@ -47,6 +48,10 @@ class ChatMessageHistory(BaseModel):
         ..., 
         description="Последовательный номер сообщения (для воссоздания истории сообщений)"
     )
+    message: str = Field(
+        ...,
+        description="Текст сообщения"
+    )
 
     model_config = {
         "from_attributes": True,
@@ -57,7 +62,20 @@ class ChatMessageHistory(BaseModel):
                 "username": "lily",
                 "channel": "general_chat",
                 "time": "2024-11-24T00:12:00Z",
-                "sequence_number": 42
+                "sequence_number": 42,
+                "message": "Привет"
             }
         }
     }
+
+
+class ChatHistoryPage(BaseModel):
+    """Страница истории сообщений чата"""
+    items: List[ChatMessageHistory] = Field(
+        ...,
+        description="Сообщения страницы по возрастанию sequence_number"
+    )
+    next_cursor: Optional[str] = Field(
+        None,
+        description="Курсор следующей страницы в том же направлении (before или after); null - страниц больше нет"
+    )
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from contextlib import suppress
+from typing import Deque, Dict, Iterable, Optional, Union
+
+from fastapi import WebSocket, WebSocketDisconnect, status
+
+from apps.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+
+
+class Frame:
+    """Сообщение для рассылки: форматируется и кодируется один раз на всех получателей
+
+    message_id и sequence_number есть у кадров сообщений истории канала.
+    """
+    __slots__ = ("text", "channel", "message_id", "sequence_number", "_data", "_tagged", "_tagged_data")
+
+    def __init__(
+        self,
+        text: str,
+        channel: Optional[str] = None,
+        message_id: Optional[str] = None,
+        sequence_number: Optional[int] = None,
+    ) -> None:
+        self.text = text
+        self.channel = channel
+        self.message_id = message_id
+        self.sequence_number = sequence_number
+        self._data: Optional[bytes] = None
+        self._tagged: Optional[str] = None
+        self._tagged_data: Optional[bytes] = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = self.text.encode("utf-8")
+        return self._data
+
+    @property
+    def tagged(self) -> str:
+        """JSON-кадр с каналом, а у сообщений истории - с номером (seq) и id для досылки после переподключения"""
+        if self._tagged is None:
+            payload = {"channel": self.channel, "text": self.text}
+            if self.sequence_number is not None:
+                payload["seq"] = self.sequence_number
+            if self.message_id is not None:
+                payload["id"] = self.message_id
+            self._tagged = json.dumps(payload, ensure_ascii=False)
+        return self._tagged
+
+    @property
+    def tagged_data(self) -> bytes:
+        if self._tagged_data is None:
+            self._tagged_data = self.tagged.encode("utf-8")
+        return self._tagged_data
+
+
+class ConnectionSender:
+    """Исходящая очередь вебсокета, которую разбирает отдельная задача-писатель"""
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_queue_size: Optional[int] = None,
+        policy: Optional[str] = None,
+        lag_disconnect_threshold: Optional[int] = None,
+        binary: bool = False,
+        multiplexed: bool = False,
+        envelope: bool = False,
+    ) -> None:
+        self.websocket = websocket
+        self.binary = binary
+        self.multiplexed = multiplexed
+        self.envelope = envelope or multiplexed
+        self.max_queue_size = max_queue_size or settings.ws_settings.send_queue_size
+        self.policy = policy or settings.ws_settings.backpressure_policy
+        # Порог выше размера очереди недостижим: очередь обрезается раньше
+        self.lag_disconnect_threshold = min(
+            lag_disconnect_threshold
+            or settings.ws_settings.lag_disconnect_threshold
+            or self.max_queue_size,
+            self.max_queue_size,
+        )
+        self.sent = 0
+        self.dropped = 0
+        self.max_lag = 0
+        self.closed = False
+        self._queue: Deque[Frame] = deque()
+        self._held: Dict[Optional[str], Deque[Frame]] = {}
+        self._held_skipped: Dict[Optional[str], int] = {}
+        self._skipped = 0
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._close_code: Optional[int] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closer: Optional[asyncio.Task] = None
+
+    @property
+    def lag(self) -> int:
+        """Количество сообщений, ожидающих отправки"""
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        """Счетчики отставания соединения"""
+        return {
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+    def start(self) -> None:
+        """Запуск задачи-писателя"""
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+
+    def send(self, frame: Union[Frame, str]) -> bool:
+        """Неблокирующая постановка сообщения в очередь соединения"""
+        if isinstance(frame, str):
+            frame = Frame(frame)
+
+        if self.closed or self._close_code is not None:
+            return False
+
+        held = self._held.get(frame.channel)
+        if held is not None:
+            return self._hold_frame(held, frame)
+
+        if self.policy == DISCONNECT and len(self._queue) >= self.lag_disconnect_threshold:
+            logger.warning(f"Клиент отстал на {len(self._queue)} сообщений, соединение закрывается")
+            self.dropped += len(self._queue) + 1
+            self._abort(status.WS_1013_TRY_AGAIN_LATER)
+            return False
+
+        if len(self._queue) >= self.max_queue_size:
+            if self.policy == COALESCE:
+                self._skipped += len(self._queue)
+                self.dropped += len(self._queue)
+                self._queue.clear()
+            else:
+                self._queue.popleft()
+                self.dropped += 1
+
+        self._push(frame)
+        return True
+
+    def hold(self, channel: Optional[str]) -> None:
+        """Задержка живых кадров канала, пока соединению досылается пропущенное"""
+        self._held.setdefault(channel, deque())
+
+    def _hold_frame(self, held: Deque[Frame], frame: Frame) -> bool:
+        """Задержанные кадры ограничены так же, как очередь, и подчиняются той же политике
+
+        Отброшенные считаются и при release заменяются пометкой о пропуске.
+        """
+        limit = self.lag_disconnect_threshold if self.policy == DISCONNECT else self.max_queue_size
+        if len(held) >= limit:
+            if self.policy == DISCONNECT:
+                logger.warning(f"Клиент отстал на {len(held)} задержанных сообщений, соединение закрывается")
+                self.dropped += len(self._queue) + len(held) + 1
+                held.clear()
+                self._abort(status.WS_1013_TRY_AGAIN_LATER)
+                return False
+
+            skipped = len(held) if self.policy == COALESCE else 1
+            for _ in range(skipped):
+                held.popleft()
+            self.dropped += skipped
+            self._held_skipped[frame.channel] = self._held_skipped.get(frame.channel, 0) + skipped
+
+        held.append(frame)
+        return True
+
+    async def release(self, channel: Optional[str], replay: Iterable[Frame] = (), after: Optional[int] = None) -> None:
+        """Отправка досланных кадров, затем задержанных живых
+
+        Досылка идет вне политики отставания: перед каждым кадром release ждет,
+        пока писатель освободит место в очереди, поэтому длинная досылка не
+        вытесняет сама себя и не закрывает соединение. Живые кадры канала
+        задерживаются до конца release. Задержанный кадр отбрасывается, если он
+        вошел в досылку (по message_id) или клиент уже видел его (sequence_number
+        не больше after).
+        """
+        try:
+            replayed = set()
+            for frame in replay:
+                if frame.message_id is not None:
+                    replayed.add(frame.message_id)
+                if not await self._wait_for_space():
+                    return
+                self._push(frame)
+
+            held = self._held.get(channel) or deque()
+            while True:
+                skipped = self._held_skipped.pop(channel, 0)
+                if skipped:
+                    frame = Frame(f"[пропущено сообщений: {skipped}]", channel)
+                elif held:
+                    frame = held.popleft()
+                    if frame.message_id is not None and frame.message_id in replayed:
+                        continue
+                    if after is not None and frame.sequence_number is not None and frame.sequence_number <= after:
+                        continue
+                else:
+                    break
+                if not await self._wait_for_space():
+                    return
+                self._push(frame)
+        finally:
+            self._held.pop(channel, None)
+            self._held_skipped.pop(channel, None)
+
+    def close(self, code: int = status.WS_1000_NORMAL_CLOSURE) -> None:
+        """Закрытие вебсокета после отправки уже поставленных в очередь сообщений"""
+        if self._close_code is None:
+            self._close_code = code
+            self._wakeup.set()
+            self._drained.set()
+
+    async def aclose(self, code: int = status.WS_1000_NORMAL_CLOSURE) -> None:
+        """Закрытие вебсокета с отправкой очереди и остановка писателя"""
+        self.close(code)
+        if self._writer is not None:
+            await asyncio.wait({self._writer}, timeout=settings.ws_settings.close_timeout)
+        await self.stop()
+
+    async def stop(self) -> None:
+        """Немедленная остановка писателя без дочитывания очереди"""
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._writer
+            self._writer = None
+        self._queue.clear()
+        self._drained.set()
+
+    def _abort(self, code: int) -> None:
+        """Закрытие соединения без ожидания зависшей отправки"""
+        self._close_code = code
+        self._queue.clear()
+        self._skipped = 0
+        self._drained.set()
+        if self._writer is not None:
+            self._writer.cancel()
+        self._closer = asyncio.create_task(self._close_quietly(code))
+
+    def _push(self, frame: Frame) -> None:
+        self._queue.append(frame)
+        self.max_lag = max(self.max_lag, len(self._queue))
+        self._wakeup.set()
+
+    async def _wait_for_space(self) -> bool:
+        """Ожидание, пока очередь не опустится ниже порога политики; False - соединение закрывается"""
+        limit = self.lag_disconnect_threshold if self.policy == DISCONNECT else self.max_queue_size
+        while not (self.closed or self._close_code is not None) and len(self._queue) >= limit:
+            self._drained.clear()
+            await self._drained.wait()
+        return not (self.closed or self._close_code is not None)
+
+    async def _close_quietly(self, code: int) -> None:
+        with suppress(RuntimeError, WebSocketDisconnect):
+            await self.websocket.close(code=code)
+        self.closed = True
+
+    async def _send_frame(self, frame: Frame) -> None:
+        if self.envelope:
+            if self.binary:
+                await self.websocket.send_bytes(frame.tagged_data)
+            else:
+                await self.websocket.send_text(frame.tagged)
+        elif self.binary:
+            await self.websocket.send_bytes(frame.data)
+        else:
+            await self.websocket.send_text(frame.text)
+
+    async def _write_loop(self) -> None:
+        websocket = self.websocket
+        try:
+            while True:
+                if self._skipped:
+                    skipped, self._skipped = self._skipped, 0
+                    await self._send_frame(Frame(f"[пропущено сообщений: {skipped}]"))
+                    continue
+
+                if self._queue:
+                    await self._send_frame(self._queue.popleft())
+                    self.sent += 1
+                    self._drained.set()
+                    continue
+
+                if self._close_code is not None:
+                    await websocket.close(code=self._close_code)
+                    break
+
+                self._wakeup.clear()
+                await self._wakeup.wait()
+        except (WebSocketDisconnect, RuntimeError) as e:
+            logger.debug(f"Отправка в вебсокет прекращена: {e}")
+        finally:
+            self.closed = True
+            self._queue.clear()
+            self._drained.set()
+            if self.dropped:
+                logger.info(f"Статистика отставания соединения: {self.stats()}")
+
+
+def broadcast(senders: Iterable[ConnectionSender], frame: Frame) -> int:
+    """Рассылка одного и того же кадра по очередям соединений без ожидания отправки"""
+    delivered = 0
+    for sender in senders:
+        if sender.send(frame):
+            delivered += 1
+    return delivered
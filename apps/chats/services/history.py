@@ -0,0 +1,129 @@
+from typing import List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from apps.chats.models.chats import ChatMessageInDB
+from apps.chats.schemas.chats import ChatHistoryPage, ChatMessageHistory
+from apps.chats.services.hot_tail import hot_tail
+from apps.mq.consumer import message_buffer
+from apps.mq.persistence import EMPTY_MESSAGE, message_id
+
+Cursor = Tuple[int, Optional[UUID]]
+
+
+def parse_cursor(value: str) -> Cursor:
+    """Курсор "{sequence_number}:{id}" или просто "{sequence_number}"; ValueError, если поврежден"""
+    sequence_number, _, cursor_id = value.partition(":")
+    return int(sequence_number), UUID(cursor_id) if cursor_id else None
+
+
+def format_cursor(message: ChatMessageHistory) -> str:
+    return f"{message.sequence_number}:{message.id}"
+
+
+def message_key(message: ChatMessageHistory) -> Tuple[int, UUID]:
+    """Порядок истории: номер сообщения, при совпадении номеров - id"""
+    return message.sequence_number, message.id
+
+
+def pending_bound(cursor: Cursor, newer: bool) -> Tuple[int, float]:
+    """Граница курсора в порядке индекса буфера записи (sequence_number, id.int)"""
+    sequence_number, cursor_id = cursor
+    if cursor_id is not None:
+        return sequence_number, cursor_id.int
+    # Курсор без id отсекает весь номер целиком
+    return sequence_number, float("inf") if newer else -1
+
+
+def keyset_condition(cursor: Cursor, newer: bool):
+    sequence_number, cursor_id = cursor
+    if cursor_id is None:
+        column = ChatMessageInDB.sequence_number
+        return column > sequence_number if newer else column < sequence_number
+
+    key = tuple_(ChatMessageInDB.sequence_number, ChatMessageInDB.id)
+    return key > tuple_(sequence_number, cursor_id) if newer else key < tuple_(sequence_number, cursor_id)
+
+
+def pending_history(
+    channel_name: str,
+    limit: int,
+    before: Optional[Cursor] = None,
+    after: Optional[Cursor] = None,
+) -> List[ChatMessageHistory]:
+    """Еще не записанные в БД сообщения канала из буфера записи, не более limit со стороны страницы"""
+    pending = message_buffer.pending(
+        channel_name,
+        after=pending_bound(after, newer=True) if after is not None else None,
+        before=pending_bound(before, newer=False) if before is not None else None,
+        limit=limit,
+        newest=after is None,
+    )
+    return [
+        ChatMessageHistory(
+            id=message_id(msg),
+            action=msg["action"],
+            username=msg["username"],
+            channel=msg["channel"],
+            time=msg["time"],
+            sequence_number=msg["sequence_number"],
+            message=msg.get("message") or EMPTY_MESSAGE,
+        )
+        for msg in pending
+    ]
+
+
+async def get_history_page(
+    session: AsyncSession,
+    channel_name: str,
+    limit: int,
+    before: Optional[Cursor] = None,
+    after: Optional[Cursor] = None,
+) -> ChatHistoryPage:
+    """Страница истории канала по курсору (keyset по sequence_number, id)
+
+    С after страница идет вперед от курсора, иначе - назад от before или от
+    конца истории. Из буфера записи и из БД берется не более limit + 1 ближайших
+    сообщений, результат сливается по id. Буфер читается до запроса к БД:
+    сообщение, записанное между ними, попадет в оба источника и будет отброшено
+    по id, но не потеряется. Последние limit событий активного канала отдаются из
+    горячего хвоста, а прочитанные из БД - дополняют его.
+    """
+    latest = before is None and after is None
+    if latest:
+        cached = hot_tail.latest(channel_name, limit)
+        if cached is not None:
+            items, has_more = cached
+            return ChatHistoryPage(items=items, next_cursor=format_cursor(items[0]) if has_more and items else None)
+
+    newer = after is not None
+    pending = pending_history(channel_name, limit + 1, before=before, after=after)
+
+    stmt = select(ChatMessageInDB).where(ChatMessageInDB.channel == channel_name)
+    if after is not None:
+        stmt = stmt.where(keyset_condition(after, newer=True))
+    if before is not None:
+        stmt = stmt.where(keyset_condition(before, newer=False))
+    if newer:
+        stmt = stmt.order_by(ChatMessageInDB.sequence_number, ChatMessageInDB.id)
+    else:
+        stmt = stmt.order_by(ChatMessageInDB.sequence_number.desc(), ChatMessageInDB.id.desc())
+    result = await session.execute(stmt.limit(limit + 1))
+
+    messages = {message.id: message for message in pending}
+    for row in result.scalars():
+        messages.setdefault(row.id, ChatMessageHistory.model_validate(row))
+
+    items = sorted(messages.values(), key=message_key, reverse=not newer)
+    has_more = len(items) > limit
+    items = items[:limit]
+    next_cursor = format_cursor(items[-1]) if has_more else None
+    if not newer:
+        items.reverse()
+    if latest:
+        hot_tail.merge(channel_name, items, complete=not has_more)
+
+    return ChatHistoryPage(items=items, next_cursor=next_cursor)
@@ -0,0 +1,174 @@
+from bisect import bisect_right, insort
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Set, Tuple
+from uuid import UUID
+
+from apps.chats.schemas.chats import ChatMessageHistory
+from apps.core.config import settings
+
+ITEM_OVERHEAD = 256  # примерный размер объекта сообщения без текста, байт
+
+
+def tail_key(item: ChatMessageHistory) -> Tuple[int, UUID]:
+    return item.sequence_number, item.id
+
+
+def item_size(item: ChatMessageHistory) -> int:
+    return ITEM_OVERHEAD + len(item.message) + len(item.username)
+
+
+class ChannelTail:
+    """Последние события канала по возрастанию (sequence_number, id)
+
+    complete - в хвосте вся история канала (загружена из БД целиком и ничего не вытеснено).
+    """
+    __slots__ = ("items", "ids", "size", "complete")
+
+    def __init__(self) -> None:
+        self.items: List[ChatMessageHistory] = []
+        self.ids: Set[UUID] = set()
+        self.size = 0
+        self.complete = False
+
+
+class HotTail:
+    """Горячий хвост истории: последние события активных каналов процесса в памяти
+
+    Хвост пополняется событиями шины рассылки, поэтому верен, только пока процесс
+    подписан на канал: open при появлении первого локального участника, close при
+    уходе последнего. Ограничен числом событий на канал, числом каналов и общим
+    объемом; при превышении вытесняются давно не использованные каналы.
+    Последние N отдаются, только если в их номерах нет пропусков: сообщение,
+    отправленное до подписки и еще не записанное в БД, иначе пропало бы из истории.
+    """
+    def __init__(self, per_channel: int, max_channels: int, max_bytes: int) -> None:
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self.max_bytes = max_bytes
+        self._tails: "OrderedDict[str, ChannelTail]" = OrderedDict()
+        self._open: Set[str] = set()
+        self._bytes = 0
+
+    def __contains__(self, channel_name: str) -> bool:
+        return channel_name in self._tails
+
+    def stats(self) -> dict:
+        return {"channels": len(self._tails), "bytes": self._bytes}
+
+    def open(self, channel_name: str) -> None:
+        """Канал получает события шины - его хвост можно вести"""
+        self._open.add(channel_name)
+
+    def close(self, channel_name: str) -> None:
+        """Процесс отписался от канала - хвост перестает быть актуальным"""
+        self._open.discard(channel_name)
+        self._drop(channel_name)
+
+    def add(self, channel_name: str, item: ChatMessageHistory) -> None:
+        """Новое событие канала из шины рассылки"""
+        tail = self._tail(channel_name)
+        if tail is None:
+            return
+        self._insert(tail, item)
+        self._trim(tail)
+        self._evict()
+
+    def merge(self, channel_name: str, items: Iterable[ChatMessageHistory], complete: bool) -> None:
+        """Дополнение хвоста последними событиями, прочитанными из БД
+
+        complete - это вся история канала, более старых событий нет.
+        """
+        tail = self._tail(channel_name)
+        if tail is None:
+            return
+        for item in items:
+            self._insert(tail, item)
+        if complete:
+            tail.complete = True
+        self._trim(tail)
+        self._evict()
+
+    def latest(self, channel_name: str, limit: int) -> Optional[Tuple[List[ChatMessageHistory], bool]]:
+        """Последние limit событий и признак наличия более старых; None - хвост не может ответить"""
+        tail = self._tails.get(channel_name)
+        if tail is None or limit > self.per_channel:
+            return None
+
+        items = tail.items[-limit:]
+        if len(items) < limit and not tail.complete:
+            return None
+        if any(current.sequence_number - previous.sequence_number > 1 for previous, current in zip(items, items[1:])):
+            return None
+
+        self._tails.move_to_end(channel_name)
+        return list(items), not (tail.complete and len(tail.items) <= limit)
+
+    def since(self, channel_name: str, sequence_number: int, limit: int) -> Optional[List[ChatMessageHistory]]:
+        """События новее sequence_number, если хвост покрывает их все без пропусков и их не больше limit"""
+        tail = self._tails.get(channel_name)
+        if tail is None:
+            return None
+
+        start = bisect_right(tail.items, sequence_number, key=lambda item: item.sequence_number)
+        # Предыдущее событие хвоста подтверждает, что между ним и первым новым ничего не пропущено
+        window = tail.items[max(start - 1, 0):]
+        if start == 0 and not tail.complete and (not window or window[0].sequence_number > sequence_number + 1):
+            return None
+        if any(current.sequence_number - previous.sequence_number > 1 for previous, current in zip(window, window[1:])):
+            return None
+
+        items = tail.items[start:]
+        if len(items) > limit:
+            return None
+        self._tails.move_to_end(channel_name)
+        return list(items)
+
+    def _tail(self, channel_name: str) -> Optional[ChannelTail]:
+        if channel_name not in self._open:
+            return None
+        tail = self._tails.get(channel_name)
+        if tail is None:
+            tail = self._tails[channel_name] = ChannelTail()
+        self._tails.move_to_end(channel_name)
+        return tail
+
+    def _insert(self, tail: ChannelTail, item: ChatMessageHistory) -> None:
+        if item.id in tail.ids:
+            return
+        tail.ids.add(item.id)
+        size = item_size(item)
+        tail.size += size
+        self._bytes += size
+        if not tail.items or tail_key(item) > tail_key(tail.items[-1]):
+            tail.items.append(item)
+        else:
+            insort(tail.items, item, key=tail_key)
+
+    def _trim(self, tail: ChannelTail) -> None:
+        excess = len(tail.items) - self.per_channel
+        if excess <= 0:
+            return
+        for item in tail.items[:excess]:
+            tail.ids.discard(item.id)
+            size = item_size(item)
+            tail.size -= size
+            self._bytes -= size
+        del tail.items[:excess]
+        tail.complete = False
+
+    def _evict(self) -> None:
+        while self._tails and (len(self._tails) > self.max_channels or self._bytes > self.max_bytes):
+            channel_name = next(iter(self._tails))
+            self._drop(channel_name)
+
+    def _drop(self, channel_name: str) -> None:
+        tail = self._tails.pop(channel_name, None)
+        if tail is not None:
+            self._bytes -= tail.size
+
+
+hot_tail = HotTail(
+    per_channel=settings.chats_settings.history_tail_size,
+    max_channels=settings.chats_settings.history_tail_channels,
+    max_bytes=settings.chats_settings.history_tail_max_bytes,
+)
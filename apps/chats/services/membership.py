@@ -0,0 +1,108 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+from uuid import UUID
+
+from apps.chats.services.chats import Service as ChatService
+from apps.core.config import settings
+from apps.users.services.users import Service as UserService
+
+_MISSING = object()
+
+
+class UserContext:
+    """Данные пользователя, нужные соединению; не привязаны к сессии БД"""
+    __slots__ = ("id", "username", "role")
+
+    def __init__(self, id: UUID, username: str, role: str) -> None:
+        self.id = id
+        self.username = username
+        self.role = role
+
+    @property
+    def is_moderator(self) -> bool:
+        return self.role == 'moderator'
+
+
+class TTLCache:
+    """Кэш с временем жизни записей и вытеснением давно не использованных"""
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        item = self._items.get(key)
+        if item is None:
+            return _MISSING
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._items[key]
+            return _MISSING
+
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+class MembershipCache:
+    """Кэш пользователей, чатов и членства в чатах для рукопожатия вебсокета"""
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.users = TTLCache(ttl, max_size)
+        self.chats = TTLCache(ttl, max_size)
+        self.links = TTLCache(ttl, max_size)
+
+    async def get_user(self, service: UserService, user_id: UUID) -> UserContext:
+        user = self.users.get(user_id)
+        if user is _MISSING:
+            user_in_db = await service.get_user_by_id(user_id, with_chats=False)
+            user = UserContext(user_in_db.id, user_in_db.username, user_in_db.role)
+            self.users.set(user_id, user)
+        return user
+
+    async def get_chat_id(self, chat_service: ChatService, channel_name: str) -> Optional[UUID]:
+        chat_id = self.chats.get(channel_name)
+        if chat_id is _MISSING:
+            chat = await chat_service.get_chat_by_name(channel_name)
+            if chat is None:
+                return None
+            chat_id = chat.id
+            self.chats.set(channel_name, chat_id)
+        return chat_id
+
+    def set_chat_id(self, channel_name: str, chat_id: UUID) -> None:
+        self.chats.set(channel_name, chat_id)
+
+    async def is_member(self, chat_service: ChatService, user_id: UUID, chat_id: UUID) -> bool:
+        """Членство в чате; кэшируется только наличие связи, отказ всегда проверяется в БД"""
+        if self.links.get((user_id, chat_id)) is True:
+            return True
+
+        link = await chat_service.get_user_chat_link(user_id=user_id, chat_id=chat_id)
+        if link:
+            self.links.set((user_id, chat_id), True)
+        return bool(link)
+
+    def set_member(self, user_id: UUID, chat_id: UUID) -> None:
+        self.links.set((user_id, chat_id), True)
+
+    def invalidate_member(self, user_id: UUID, chat_id: UUID) -> None:
+        self.links.invalidate((user_id, chat_id))
+
+
+membership_cache = MembershipCache(
+    ttl=settings.ws_settings.membership_cache_ttl,
+    max_size=settings.ws_settings.membership_cache_size,
+)
@@ -0,0 +1,481 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from fastapi import HTTPException, WebSocket
+
+from apps.chats.models import ChatMessageInDB
+from apps.chats.schemas.chats import ChatCreate, ChatMessageHistory
+from apps.chats.services.broadcaster import ConnectionSender, Frame, broadcast
+from apps.chats.services.chats import Service as ChatService
+from apps.chats.services.history import get_history_page
+from apps.chats.services.hot_tail import hot_tail
+from apps.chats.services.membership import UserContext, membership_cache
+from apps.chats.services.registry import ChannelRegistry, ConnectionRecord
+from apps.core.config import settings
+from apps.db import async_session
+from apps.mq.consumer import consumer_registry
+from apps.mq.fanout import fanout_bus
+from apps.mq.persistence import EMPTY_MESSAGE
+from apps.mq.publisher import (forget_sequence_number, handle_moderator_action,
+                               handle_user_activity, note_sequence_number,
+                               publisher, send_message_to_queue)
+from apps.users.services.users import Service as UserService
+
+logger = logging.getLogger(__name__)
+
+active_channels: ChannelRegistry = ChannelRegistry()
+blocked_users: Dict[str, Dict[str, UUID]] = {}
+invited_users: Dict[str, List[str]] = {}
+idle_channels: Dict[str, float] = {}
+
+
+class ChannelContext:
+    """Подписка соединения на канал"""
+    __slots__ = ("channel_name", "chat_id", "user_id", "username", "is_moderator", "websocket", "sender")
+
+    def __init__(
+        self,
+        channel_name: str,
+        chat_id: UUID,
+        user: UserContext,
+        websocket: WebSocket,
+        sender: ConnectionSender,
+    ) -> None:
+        self.channel_name = channel_name
+        self.chat_id = chat_id
+        self.user_id = user.id
+        self.username = user.username
+        self.is_moderator = user.is_moderator
+        self.websocket = websocket
+        self.sender = sender
+
+    @property
+    def is_active(self) -> bool:
+        """Соединение все еще участник канала (не было заблокировано)"""
+        channel = active_channels.get(self.channel_name)
+        return channel is not None and channel.get(self.websocket) is not None
+
+    def reply(self, text: str) -> None:
+        """Ответ только этому соединению"""
+        self.sender.send(Frame(text, self.channel_name))
+
+
+def current_times() -> Tuple[str, str]:
+    """Время для отображения в чате и для сообщений в очередь"""
+    return datetime.now().strftime('%H:%M'), datetime.now(timezone.utc).isoformat()
+
+
+def history_item(message_data: dict) -> dict:
+    """Опубликованное событие канала в виде элемента истории для горячих хвостов всех процессов
+
+    Данные уже прошли проверку при публикации, поэтому схема повторно не валидируется.
+    """
+    sent_at = message_data["time"]
+    return {
+        "id": str(message_data["id"]),
+        "action": message_data["action"],
+        "username": message_data["username"],
+        "channel": message_data["channel"],
+        "time": sent_at if isinstance(sent_at, str) else sent_at.isoformat(),
+        "sequence_number": message_data["sequence_number"],
+        "message": message_data.get("message") or EMPTY_MESSAGE,
+    }
+
+
+def history_from_event(history: dict) -> ChatMessageHistory:
+    """Элемент горячего хвоста из события шины, собранного history_item, без повторной валидации"""
+    return ChatMessageHistory.model_construct(
+        id=UUID(history["id"]),
+        action=history["action"],
+        username=history["username"],
+        channel=history["channel"],
+        time=datetime.fromisoformat(history["time"]),
+        sequence_number=history["sequence_number"],
+        message=history["message"],
+    )
+
+
+async def share_history(channel_name: str, message_data: dict) -> None:
+    """Событие без кадра для участников (вход, выход, действия модератора) - только в горячие хвосты"""
+    await fanout_bus.publish(channel_name, {"type": "history", "history": history_item(message_data)})
+
+
+async def deliver_event(channel_name: str, event: dict) -> None:
+    """Доставка события шины рассылки локальным участникам канала"""
+    item = None
+    if "history" in event:
+        item = history_from_event(event["history"])
+        hot_tail.add(channel_name, item)
+        note_sequence_number(channel_name, item.sequence_number)
+        if event["type"] == "history":
+            return
+
+    if event["type"] == "kick":
+        membership_cache.invalidate_member(UUID(event["user_id"]), UUID(event["chat_id"]))
+
+    channel = active_channels.get(channel_name)
+    if channel is None:
+        return
+
+    if event["type"] == "kick":
+        for connection in channel.by_username(event["username"]):
+            connection.sender.send(Frame(event["text"], channel_name))
+            if not connection.sender.multiplexed:
+                connection.sender.close()
+            await drop_member(channel_name, connection.websocket)
+        return
+
+    if item is not None:
+        frame = Frame(event["text"], channel_name, message_id=str(item.id), sequence_number=item.sequence_number)
+    else:
+        frame = Frame(event["text"], channel_name)
+    if not event.get("self_text"):
+        broadcast((connection.sender for connection in channel.members()), frame)
+        return
+
+    self_frame = Frame(event["self_text"], channel_name)
+    user_id = UUID(event["user_id"])
+    for connection in channel.members():
+        connection.sender.send(self_frame if connection.user_id == user_id else frame)
+
+fanout_bus.on_event(deliver_event)
+
+
+async def deliver_broadcast(event: dict) -> None:
+    """Событие для всех процессов: сброс закэшированного членства заблокированного пользователя"""
+    if event["type"] == "invalidate_member":
+        membership_cache.invalidate_member(UUID(event["user_id"]), UUID(event["chat_id"]))
+
+fanout_bus.on_broadcast(deliver_broadcast)
+
+
+async def load_user(user_id: UUID) -> UserContext:
+    """Загрузка пользователя из кэша или в отдельной короткой сессии"""
+    async with async_session() as session:
+        return await membership_cache.get_user(UserService(session), user_id)
+
+
+async def drop_member(channel_name: str, websocket: WebSocket) -> None:
+    """Удаление соединения из реестра канала; после последнего участника процесс отписывается от канала
+
+    Ссылку на потребителя очереди снимает leave_channel: она принадлежит контексту соединения.
+    """
+    active_channels.remove(channel_name, websocket)
+    if channel_name not in active_channels:
+        await fanout_bus.unsubscribe(channel_name)
+        hot_tail.close(channel_name)
+        forget_sequence_number(channel_name)
+        mark_idle(channel_name)
+
+
+def mark_idle(channel_name: str) -> None:
+    """Отметка канала без участников для сборщика простаивающих каналов"""
+    if channel_name not in active_channels:
+        idle_channels.setdefault(channel_name, time.monotonic())
+
+
+async def reap_idle_channels(max_idle: float) -> int:
+    """Освобождение состояния и потребителей каналов, в которых давно нет участников"""
+    deadline = time.monotonic() - max_idle
+    expired = [channel_name for channel_name, since in idle_channels.items() if since <= deadline]
+
+    for channel_name in expired:
+        del idle_channels[channel_name]
+        if channel_name in active_channels:
+            continue
+
+        blocked_users.pop(channel_name, None)
+        invited_users.pop(channel_name, None)
+        await consumer_registry.close_channel(channel_name)
+        publisher.forget_channel(channel_name)
+
+    return len(expired)
+
+
+async def run_channel_reaper() -> None:
+    """Фоновая задача сборщика простаивающих каналов"""
+    while True:
+        await asyncio.sleep(settings.ws_settings.reaper_interval)
+        try:
+            reaped = await reap_idle_channels(settings.ws_settings.idle_channel_ttl)
+            if reaped:
+                logger.info(f"Освобождено простаивающих каналов: {reaped}")
+        except Exception as e:
+            logger.error(f"Ошибка сборщика простаивающих каналов: {e}")
+
+
+async def join_channel(
+    websocket: WebSocket,
+    sender: ConnectionSender,
+    user: UserContext,
+    channel_name: str,
+) -> Optional[ChannelContext]:
+    """Проверка доступа и подключение соединения к каналу
+
+    Живые кадры канала задерживаются до send_recent_history или resume_channel,
+    чтобы не прийти раньше истории и не повториться в ней.
+    """
+    async with async_session() as session:
+        chat_service = ChatService(session)
+        chat_id = await membership_cache.get_chat_id(chat_service, channel_name)
+
+        if not chat_id:
+            chat = await chat_service.create_chat(ChatCreate(id=uuid4(), name=channel_name))
+            chat_id = chat.id
+            await chat_service.create_user_chat_link(user_id=user.id, chat_id=chat_id)
+            membership_cache.set_chat_id(channel_name, chat_id)
+            membership_cache.set_member(user.id, chat_id)
+        else:
+            link_exists = await membership_cache.is_member(chat_service, user.id, chat_id)
+            if not link_exists and not user.is_moderator:
+                sender.send(Frame("Доступ запрещен: Вы не были приглашены в этот чат.", channel_name))
+                return None
+
+        if channel_name not in invited_users:
+            invited_users[channel_name] = []
+            invited_users[channel_name].append(user.username)
+
+        if channel_name not in blocked_users:
+            blocked_users[channel_name] = {}
+
+        if user.username in blocked_users[channel_name]:
+            await chat_service.delete_user_chat_link(user_id=user.id, chat_id=chat_id)
+            membership_cache.invalidate_member(user.id, chat_id)
+            sender.send(Frame("Вы были заблокированы в этом канале. Доступ запрещен.", channel_name))
+            mark_idle(channel_name)
+            return None
+
+    idle_channels.pop(channel_name, None)
+    sender.hold(channel_name)
+    context = ChannelContext(channel_name, chat_id, user, websocket, sender)
+    channel = active_channels.add(channel_name, ConnectionRecord(user.id, user.username, websocket, sender))
+    if len(channel) == 1:
+        await fanout_bus.subscribe(channel_name)
+        hot_tail.open(channel_name)
+    consumer_registry.acquire_channel(channel_name)
+
+    current_time_chat, current_time_rabbit = current_times()
+
+    await fanout_bus.publish(channel_name, {
+        "type": "frame",
+        "text": f"[{current_time_chat}] {'Модератор' if context.is_moderator else 'Пользователь'} {user.username} вошел в чат",
+        "self_text": f"[{current_time_chat}] Вы вошли в чат",
+        "user_id": str(user.id),
+    })
+
+    activity = await handle_user_activity("connect", user.username, channel_name, current_time_rabbit)
+    await share_history(channel_name, activity)
+    return context
+
+
+def history_frames(channel_name: str, items: List[ChatMessageHistory]) -> List[Frame]:
+    """Кадры сообщений истории в том же виде, что и живые"""
+    return [
+        Frame(
+            f"[{item.time.astimezone().strftime('%H:%M')}] {item.username}: {item.message}",
+            channel_name,
+            message_id=str(item.id),
+            sequence_number=item.sequence_number,
+        )
+        for item in items
+        if item.action == "message"
+    ]
+
+
+async def send_recent_history(context: ChannelContext) -> None:
+    """Последние сообщения канала соединению сразу после входа: из горячего хвоста или из БД
+
+    Затем отправляются задержанные join_channel живые кадры без вошедших в историю.
+    """
+    channel_name = context.channel_name
+    limit = settings.ws_settings.join_history_size
+    frames: List[Frame] = []
+    try:
+        if limit:
+            cached = hot_tail.latest(channel_name, limit)
+            if cached is not None:
+                items = cached[0]
+            else:
+                async with async_session() as session:
+                    items = (await get_history_page(session, channel_name, limit)).items
+            frames = history_frames(channel_name, items)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить последние сообщения канала {channel_name}: {e}")
+    finally:
+        await context.sender.release(channel_name, frames)
+
+
+async def missed_events(channel_name: str, last_sequence_number: int) -> Tuple[List[ChatMessageHistory], bool]:
+    """События новее last_sequence_number и признак, что досылка обрезана пределом resume_max_replay"""
+    limit = settings.ws_settings.resume_max_replay
+    items = hot_tail.since(channel_name, last_sequence_number, limit)
+    if items is not None:
+        return items, False
+
+    async with async_session() as session:
+        page = await get_history_page(session, channel_name, limit)
+    items = [item for item in page.items if item.sequence_number > last_sequence_number]
+    return items, page.next_cursor is not None and len(items) == len(page.items)
+
+
+async def resume_channel(context: ChannelContext, last_sequence_number: int) -> None:
+    """Досылка пропущенного после переподключения, затем переход на живую доставку
+
+    Живые кадры, пришедшие во время досылки, задержаны join_channel
+    и отправляются после нее без вошедших в досылку и уже виденных клиентом.
+    """
+    channel_name = context.channel_name
+    replay: List[Frame] = []
+    try:
+        items, truncated = await missed_events(channel_name, last_sequence_number)
+        if truncated:
+            replay.append(Frame("[часть пропущенных сообщений доступна только в истории чата]", channel_name))
+        replay.extend(history_frames(channel_name, items))
+    except Exception as e:
+        logger.error(f"Не удалось дослать пропущенные сообщения канала {channel_name}: {e}")
+    finally:
+        await context.sender.release(channel_name, replay, after=last_sequence_number)
+
+
+async def leave_channel(context: ChannelContext) -> None:
+    """Удаление соединения из канала и оповещение оставшихся участников
+
+    Вызывается ровно один раз на контекст, в том числе для исключенного из канала
+    (kick уже убрал его из реестра): снимает ссылку на потребителя очереди.
+    """
+    channel_name = context.channel_name
+    await drop_member(channel_name, context.websocket)
+    consumer_registry.release_channel(channel_name)
+
+    current_time_chat, current_time_rabbit = current_times()
+
+    await fanout_bus.publish(channel_name, {
+        "type": "frame",
+        "text": f"[{current_time_chat}] {'Модератор' if context.is_moderator else 'Пользователь'} {context.username} вышел из чата",
+        "self_text": f"[{current_time_chat}] Вы вышли из чата",
+        "user_id": str(context.user_id),
+    })
+
+    activity = await handle_user_activity("disconnect", context.username, channel_name, current_time_rabbit)
+    await share_history(channel_name, activity)
+
+
+async def find_user(service: UserService, username: str) -> Optional[UserContext]:
+    """Поиск пользователя по имени без исключения, если его нет"""
+    try:
+        user = await service.get_user_by_name(username)
+    except HTTPException:
+        return None
+    return UserContext(user.id, user.username, user.role)
+
+
+async def handle_moderator_command(context: ChannelContext, data: str) -> bool:
+    """Обработка команд модератора; возвращает True, если сообщение было командой"""
+    if not context.is_moderator or not data.startswith(("/invite ", "/block ", "/unblock ")):
+        return False
+
+    async with async_session() as session:
+        await run_moderator_command(context, data, UserService(session), ChatService(session))
+    return True
+
+
+async def run_moderator_command(
+    context: ChannelContext,
+    data: str,
+    service: UserService,
+    chat_service: ChatService,
+) -> None:
+    channel_name = context.channel_name
+    chat_id = context.chat_id
+    current_time_chat, current_time_rabbit = current_times()
+    command, target_username = data.split(" ", 1)
+    target_username = target_username.strip()
+    target_user = await find_user(service, target_username)
+
+    if not target_user:
+        context.reply(f"[{current_time_chat}] Пользователь {target_username} не существует.")
+        return
+
+    if command == "/invite":
+        existing_link = await membership_cache.is_member(chat_service, target_user.id, chat_id)
+        if existing_link:
+            context.reply(f"[{current_time_chat}] Пользователь {target_username} уже в чате.")
+            return
+
+        await chat_service.create_user_chat_link(user_id=target_user.id, chat_id=chat_id)
+        membership_cache.set_member(target_user.id, chat_id)
+        context.reply(f"[{current_time_chat}] Пользователь {target_username} был приглашён в чат.")
+        activity = await handle_user_activity("invited", target_username, channel_name, current_time_rabbit)
+        await share_history(channel_name, activity)
+
+    elif command == "/block":
+        blocked_user_link = await chat_service.get_user_chat_link(user_id=target_user.id, chat_id=chat_id)
+        if not blocked_user_link:
+            context.reply(f"[{current_time_chat}] Пользователь {target_username} не в чате.")
+            return
+
+        await fanout_bus.publish(channel_name, {
+            "type": "kick",
+            "username": target_username,
+            "user_id": str(target_user.id),
+            "chat_id": str(chat_id),
+            "text": f"Вы были заблокированы в канале {channel_name}.",
+        })
+
+        blocked_users[channel_name][target_username] = target_user.id
+
+        await chat_service.delete_user_chat_link(user_id=target_user.id, chat_id=chat_id)
+        # blocked_users есть только у этого процесса: остальные после сброса кэша проверят связь в БД
+        await fanout_bus.broadcast({
+            "type": "invalidate_member",
+            "user_id": str(target_user.id),
+            "chat_id": str(chat_id),
+        })
+        context.reply(f"[{current_time_chat}] Пользователь {target_username} был заблокирован.")
+        activity = await handle_moderator_action("blocked", target_username, channel_name, current_time_rabbit)
+        await share_history(channel_name, activity)
+
+    else:
+        if target_username not in blocked_users[channel_name]:
+            context.reply(f"[{current_time_chat}] Пользователь {target_username} не заблокирован.")
+            return
+
+        del blocked_users[channel_name][target_username]
+
+        existing_link = await chat_service.get_user_chat_link(user_id=target_user.id, chat_id=chat_id)
+        if existing_link:
+            context.reply(f"[{current_time_chat}] Пользователь {target_username} уже в чате.")
+        else:
+            await chat_service.create_user_chat_link(user_id=target_user.id, chat_id=chat_id)
+            membership_cache.set_member(target_user.id, chat_id)
+            context.reply(f"[{current_time_chat}] Пользователь {target_username} был успешно разблокирован.")
+            activity = await handle_moderator_action("unblocked", target_username, channel_name, current_time_rabbit)
+            await share_history(channel_name, activity)
+
+
+async def post_message(context: ChannelContext, data: str) -> None:
+    """Сохранение сообщения через очередь и рассылка участникам канала"""
+    channel_name = context.channel_name
+    current_time_chat, current_time_rabbit = current_times()
+
+    message_data = ChatMessageInDB(
+        action="message",
+        username=context.username,
+        channel=channel_name,
+        time=current_time_rabbit,
+        created_at=datetime.now(timezone.utc).isoformat(),
+        updated_at=datetime.now(timezone.utc).isoformat(),
+        id = str(uuid4()),
+        message=data,
+    )
+    published = await send_message_to_queue(channel_name, message_data.dict())
+
+    await fanout_bus.publish(channel_name, {
+        "type": "frame",
+        "text": f"[{current_time_chat}] {message_data.username}: {data}",
+        "history": history_item(published),
+    })
@@ -0,0 +1,106 @@
+from typing import Dict, Iterator, Optional, Tuple
+from uuid import UUID
+
+from fastapi import WebSocket
+
+from apps.chats.services.broadcaster import ConnectionSender
+
+
+class ConnectionRecord:
+    """Участник канала, подключенный через вебсокет"""
+    __slots__ = ("user_id", "username", "websocket", "sender")
+
+    def __init__(self, user_id: UUID, username: str, websocket: WebSocket, sender: ConnectionSender) -> None:
+        self.user_id = user_id
+        self.username = username
+        self.websocket = websocket
+        self.sender = sender
+
+
+class Channel:
+    """Участники одного канала с индексами по сокету, id и имени пользователя"""
+    __slots__ = ("name", "_by_socket", "_by_user", "_by_username", "_snapshot")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._by_socket: Dict[int, ConnectionRecord] = {}
+        self._by_user: Dict[UUID, Dict[int, ConnectionRecord]] = {}
+        self._by_username: Dict[str, Dict[int, ConnectionRecord]] = {}
+        self._snapshot: Optional[Tuple[ConnectionRecord, ...]] = None
+
+    def __len__(self) -> int:
+        return len(self._by_socket)
+
+    def __iter__(self) -> Iterator[ConnectionRecord]:
+        return iter(self.members())
+
+    def add(self, record: ConnectionRecord) -> None:
+        key = id(record.websocket)
+        self._by_socket[key] = record
+        self._by_user.setdefault(record.user_id, {})[key] = record
+        self._by_username.setdefault(record.username, {})[key] = record
+        self._snapshot = None
+
+    def remove(self, websocket: WebSocket) -> Optional[ConnectionRecord]:
+        key = id(websocket)
+        record = self._by_socket.pop(key, None)
+        if record is None:
+            return None
+
+        self._discard(self._by_user, record.user_id, key)
+        self._discard(self._by_username, record.username, key)
+        self._snapshot = None
+        return record
+
+    def get(self, websocket: WebSocket) -> Optional[ConnectionRecord]:
+        return self._by_socket.get(id(websocket))
+
+    def by_user(self, user_id: UUID) -> Tuple[ConnectionRecord, ...]:
+        return tuple(self._by_user.get(user_id, {}).values())
+
+    def by_username(self, username: str) -> Tuple[ConnectionRecord, ...]:
+        return tuple(self._by_username.get(username, {}).values())
+
+    def members(self) -> Tuple[ConnectionRecord, ...]:
+        """Неизменяемый снимок участников, безопасный для обхода во время изменений"""
+        if self._snapshot is None:
+            self._snapshot = tuple(self._by_socket.values())
+        return self._snapshot
+
+    @staticmethod
+    def _discard(index: Dict, value, key: int) -> None:
+        records = index.get(value)
+        if records is None:
+            return
+        records.pop(key, None)
+        if not records:
+            del index[value]
+
+
+class ChannelRegistry:
+    """Реестр активных каналов процесса"""
+    def __init__(self) -> None:
+        self._channels: Dict[str, Channel] = {}
+
+    def __contains__(self, channel_name: str) -> bool:
+        return channel_name in self._channels
+
+    def get(self, channel_name: str) -> Optional[Channel]:
+        return self._channels.get(channel_name)
+
+    def add(self, channel_name: str, record: ConnectionRecord) -> Channel:
+        channel = self._channels.get(channel_name)
+        if channel is None:
+            channel = self._channels[channel_name] = Channel(channel_name)
+        channel.add(record)
+        return channel
+
+    def remove(self, channel_name: str, websocket: WebSocket) -> Optional[ConnectionRecord]:
+        channel = self._channels.get(channel_name)
+        if channel is None:
+            return None
+
+        record = channel.remove(websocket)
+        if not channel:
+            del self._channels[channel_name]
+        return record
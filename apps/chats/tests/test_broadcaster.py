@@ -0,0 +1,226 @@
+import asyncio
+
+import pytest
+from pydantic import ValidationError
+
+from apps.chats.services.broadcaster import ConnectionSender, Frame, broadcast
+from apps.core.config import WebSocketSettings
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.sent = []
+        self.close_code = None
+
+    async def send_text(self, data: str):
+        await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+
+@pytest.mark.asyncio
+async def test_slow_connection_does_not_block_broadcast():
+    fast, slow = FakeWebSocket(), FakeWebSocket(delay=10)
+    senders = [ConnectionSender(fast), ConnectionSender(slow)]
+    for sender in senders:
+        sender.start()
+
+    delivered = broadcast(senders, "hello")
+    await asyncio.sleep(0.01)
+
+    assert delivered == 2
+    assert fast.sent == ["hello"]
+    assert slow.sent == []
+
+    for sender in senders:
+        await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_close_drains_queue_before_closing():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket)
+    sender.start()
+
+    sender.send("first")
+    sender.send("second")
+    sender.close(code=1008)
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ["first", "second"]
+    assert websocket.close_code == 1008
+    assert sender.closed
+    assert not sender.send("late")
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_keeps_latest_messages():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, max_queue_size=2, policy="drop_oldest")
+
+    for i in range(5):
+        sender.send(f"m{i}")
+    sender.start()
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ["m3", "m4"]
+    assert sender.dropped == 3
+    assert sender.max_lag == 2
+    await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_replaces_backlog_with_marker():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, max_queue_size=2, policy="coalesce")
+
+    for i in range(5):
+        sender.send(f"m{i}")
+    sender.start()
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ["[пропущено сообщений: 4]", "m4"]
+    assert sender.dropped == 4
+    await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_closes_lagging_client():
+    websocket = FakeWebSocket(delay=10)
+    sender = ConnectionSender(websocket, max_queue_size=10, policy="disconnect", lag_disconnect_threshold=3)
+    sender.start()
+
+    results = [sender.send(f"m{i}") for i in range(6)]
+    await asyncio.sleep(0.01)
+
+    assert results[:3] == [True, True, True]
+    assert not any(results[3:])
+    assert websocket.close_code == 1013
+    assert sender.closed
+
+
+def test_disconnect_threshold_cannot_exceed_queue_size():
+    with pytest.raises(ValidationError):
+        WebSocketSettings(send_queue_size=10, lag_disconnect_threshold=11)
+    with pytest.raises(ValidationError):
+        WebSocketSettings(send_queue_size=10, resume_max_replay=11)
+
+    sender = ConnectionSender(FakeWebSocket(), max_queue_size=10, policy="disconnect", lag_disconnect_threshold=50)
+    assert sender.lag_disconnect_threshold == 10
+
+
+@pytest.mark.asyncio
+async def test_held_overflow_follows_policy_and_leaves_marker():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, max_queue_size=2, policy="coalesce")
+    sender.start()
+
+    sender.hold("general")
+    for i in range(5):
+        sender.send(Frame(f"m{i}", "general"))
+    await sender.release("general")
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ["[пропущено сообщений: 4]", "m4"]
+    await sender.stop()
+
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, max_queue_size=10, policy="disconnect", lag_disconnect_threshold=2)
+    sender.start()
+    sender.hold("general")
+    results = [sender.send(Frame(f"m{i}", "general")) for i in range(3)]
+    await asyncio.sleep(0.01)
+
+    assert results == [True, True, False]
+    assert websocket.close_code == 1013
+
+
+@pytest.mark.asyncio
+async def test_frame_is_encoded_once_for_all_binary_recipients():
+    class BinaryWebSocket(FakeWebSocket):
+        async def send_bytes(self, data: bytes):
+            self.sent.append(data)
+
+    websockets = [BinaryWebSocket() for _ in range(3)]
+    senders = [ConnectionSender(websocket, binary=True) for websocket in websockets]
+    for sender in senders:
+        sender.start()
+
+    frame = Frame("привет")
+    broadcast(senders, frame)
+    await asyncio.sleep(0.01)
+
+    assert all(websocket.sent[0] is frame.data for websocket in websockets)
+    for sender in senders:
+        await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_multiplexed_sender_tags_frames_with_channel():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, multiplexed=True)
+    sender.start()
+
+    sender.send(Frame("hello", "general"))
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ['{"channel": "general", "text": "hello"}']
+    await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_envelope_carries_sequence_number_and_id():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, envelope=True)
+    sender.start()
+
+    sender.send(Frame("hello", "general", message_id="m7", sequence_number=7))
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ['{"channel": "general", "text": "hello", "seq": 7, "id": "m7"}']
+    await sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_held_frames_follow_replay_without_duplicates():
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket)
+    sender.start()
+
+    sender.hold("general")
+    sender.send(Frame("live 4", "general", message_id="m4", sequence_number=4))
+    sender.send(Frame("live 5", "general", message_id="m5", sequence_number=5))
+    sender.send(Frame("old 2", "general", message_id="m2", sequence_number=2))
+    sender.send(Frame("other", "random"))
+    await asyncio.sleep(0.01)
+    assert websocket.sent == ["other"]
+
+    await sender.release("general", [
+        Frame("replay 3", "general", message_id="m3", sequence_number=3),
+        Frame("replay 4", "general", message_id="m4", sequence_number=4),
+    ], after=2)
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == ["other", "replay 3", "replay 4", "live 5"]
+    await sender.stop()
+
+
+@pytest.mark.parametrize("policy", ["drop_oldest", "coalesce", "disconnect"])
+@pytest.mark.asyncio
+async def test_replay_longer_than_queue_is_delivered_whole(policy):
+    websocket = FakeWebSocket()
+    sender = ConnectionSender(websocket, max_queue_size=8, policy=policy)
+    sender.start()
+
+    sender.hold("general")
+    sender.send(Frame("live 31", "general", message_id="m31", sequence_number=31))
+    replay = [Frame(f"replay {seq}", "general", message_id=f"m{seq}", sequence_number=seq) for seq in range(1, 31)]
+    await sender.release("general", replay, after=0)
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == [f"replay {seq}" for seq in range(1, 31)] + ["live 31"]
+    assert sender.dropped == 0 and not sender.closed
+    await sender.stop()
@@ -0,0 +1,127 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from apps.chats.models.chats import ChatMessageInDB
+from apps.chats.services import history
+from apps.mq.buffer import WriteBehindBuffer
+from apps.users.models.users import UserInDB  # noqa: F401 - связь ChatInDB.users
+
+
+class SQLiteSession:
+    """Сессия над SQLite в памяти: запросы истории выполняются настоящим SQL
+
+    Схема public подключается как отдельная база, чтобы таблицы совпадали с моделями.
+    """
+    def __init__(self, rows=()):
+        self.engine = create_engine("sqlite://")
+        event.listen(self.engine, "connect", lambda connection, _: connection.execute("ATTACH ':memory:' AS public"))
+        self.session = Session(self.engine)
+        ChatMessageInDB.__table__.create(self.session.connection())
+        self.session.add_all(rows)
+        self.session.commit()
+        self.statements = []
+
+    async def execute(self, stmt):
+        self.statements.append(str(stmt.compile(dialect=postgresql.dialect())))
+        return self.session.execute(stmt)
+
+
+async def noop_writer(messages):
+    pass
+
+
+def message(seq: int, message_id=None) -> dict:
+    return {
+        "id": str(message_id or uuid4()), "action": "message", "username": "alice", "channel": "general",
+        "time": datetime.now(timezone.utc), "sequence_number": seq, "message": f"m{seq}",
+    }
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    buffer = WriteBehindBuffer(
+        noop_writer, max_messages=1000, max_bytes=1 << 20, max_age=10,
+        min_batch=1000, max_batch=1000, target_latency=1,
+    )
+    monkeypatch.setattr(history, "message_buffer", buffer)
+    return buffer
+
+
+def test_parse_cursor():
+    message_id = uuid4()
+    assert history.parse_cursor(f"12:{message_id}") == (12, message_id)
+    assert history.parse_cursor("12") == (12, None)
+    with pytest.raises(ValueError):
+        history.parse_cursor("abc")
+
+
+@pytest.mark.asyncio
+async def test_latest_page_and_before_cursor(buffer):
+    for seq in range(1, 8):
+        await buffer.put(message(seq), 10)
+
+    page = await history.get_history_page(SQLiteSession(), "general", limit=3)
+    assert [m.sequence_number for m in page.items] == [5, 6, 7]
+
+    page = await history.get_history_page(SQLiteSession(), "general", limit=3, before=history.parse_cursor(page.next_cursor))
+    assert [m.sequence_number for m in page.items] == [2, 3, 4]
+
+    page = await history.get_history_page(SQLiteSession(), "general", limit=3, before=history.parse_cursor(page.next_cursor))
+    assert [m.sequence_number for m in page.items] == [1]
+    assert page.next_cursor is None
+
+    page = await history.get_history_page(SQLiteSession(), "general", limit=3, after=(4, None))
+    assert [m.sequence_number for m in page.items] == [5, 6, 7]
+    assert page.next_cursor is None
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_message_in_db_and_buffer_is_returned_once(buffer):
+    message_id = uuid4()
+    await buffer.put(message(1, message_id), 10)
+    row = ChatMessageInDB(
+        id=message_id, action="message", username="alice", channel="general",
+        time=datetime.now(timezone.utc), sequence_number=1, message="m1",
+    )
+
+    page = await history.get_history_page(SQLiteSession([row]), "general", limit=10)
+    assert [m.id for m in page.items] == [message_id]
+    await buffer.stop()
+
+
+def row(seq: int, message_id=None, channel: str = "general") -> ChatMessageInDB:
+    return ChatMessageInDB(
+        id=message_id or uuid4(), action="message", username="alice", channel=channel,
+        time=datetime.now(timezone.utc), sequence_number=seq, message=f"m{seq}",
+    )
+
+
+@pytest.mark.asyncio
+async def test_keyset_pages_over_db_rows_with_equal_sequence_numbers(buffer):
+    # Номера 3 и 4 повторяются: до единого счетчика их могли выдать два процесса
+    rows = [row(seq) for seq in (1, 2, 3, 3, 4, 4, 5)] + [row(9, channel="random")]
+    session = SQLiteSession(rows)
+    expected = sorted(((r.sequence_number, r.id) for r in rows if r.channel == "general"))
+
+    pages, cursor = [], None
+    while True:
+        page = await history.get_history_page(session, "general", limit=2, before=cursor)
+        pages = [(m.sequence_number, m.id) for m in page.items] + pages
+        if page.next_cursor is None:
+            break
+        cursor = history.parse_cursor(page.next_cursor)
+    assert pages == expected
+
+    page = await history.get_history_page(session, "general", limit=3, after=history.parse_cursor(f"3:{expected[2][1]}"))
+    assert [(m.sequence_number, m.id) for m in page.items] == expected[3:6]
+    assert page.next_cursor == f"4:{expected[5][1]}"
+
+    assert "(public.chat_messages.sequence_number, public.chat_messages.id) <" in session.statements[1]
+    assert "ORDER BY public.chat_messages.sequence_number DESC, public.chat_messages.id DESC" in session.statements[1]
+    await buffer.stop()
@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from apps.chats.schemas.chats import ChatMessageHistory
+from apps.chats.services.hot_tail import HotTail
+
+
+def item(seq: int, channel: str = "general") -> ChatMessageHistory:
+    return ChatMessageHistory(
+        id=uuid4(), action="message", username="alice", channel=channel,
+        time=datetime.now(timezone.utc), sequence_number=seq, message=f"m{seq}",
+    )
+
+
+def test_latest_is_served_only_without_gaps():
+    tail = HotTail(per_channel=10, max_channels=10, max_bytes=1 << 20)
+    tail.add("general", item(1))
+    assert "general" not in tail
+
+    tail.open("general")
+    for seq in (5, 7, 6):
+        tail.add("general", item(seq))
+
+    items, has_more = tail.latest("general", 3)
+    assert [i.sequence_number for i in items] == [5, 6, 7]
+    assert has_more
+    assert tail.latest("general", 4) is None
+
+    tail.add("general", item(9))
+    assert tail.latest("general", 2) is None
+
+    tail.merge("general", [item(seq) for seq in range(1, 5)] + [item(8)], complete=True)
+    items, has_more = tail.latest("general", 10)
+    assert [i.sequence_number for i in items] == list(range(1, 10))
+    assert not has_more
+
+    tail.close("general")
+    assert tail.latest("general", 1) is None
+
+
+def test_trim_and_lru_eviction():
+    tail = HotTail(per_channel=3, max_channels=2, max_bytes=1 << 20)
+    for channel in ("a", "b", "c"):
+        tail.open(channel)
+
+    tail.merge("a", [item(1, "a")], complete=True)
+    for seq in range(2, 6):
+        tail.add("a", item(seq, "a"))
+    items, has_more = tail.latest("a", 3)
+    assert [i.sequence_number for i in items] == [3, 4, 5]
+    assert has_more
+
+    tail.add("b", item(1, "b"))
+    tail.latest("a", 1)
+    tail.add("c", item(1, "c"))
+    assert "a" in tail and "c" in tail and "b" not in tail
+    assert tail.stats()["channels"] == 2
+
+
+def test_since_requires_continuous_coverage():
+    tail = HotTail(per_channel=10, max_channels=10, max_bytes=1 << 20)
+    tail.open("general")
+    for seq in (5, 6, 7):
+        tail.add("general", item(seq))
+
+    assert [i.sequence_number for i in tail.since("general", 5, limit=10)] == [6, 7]
+    assert [i.sequence_number for i in tail.since("general", 4, limit=10)] == [5, 6, 7]
+    assert tail.since("general", 3, limit=10) is None
+    assert tail.since("general", 4, limit=2) is None
+    assert tail.since("general", 7, limit=10) == []
+
+    tail.add("general", item(9))
+    assert tail.since("general", 6, limit=10) is None
+    assert tail.since("general", 7, limit=10) is None
@@ -0,0 +1,192 @@
+import asyncio
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+from pydantic import ValidationError
+
+from apps.chats.models import ChatMessageInDB
+from apps.chats.schemas.chats import ChatCreate, ChatMessageHistory
+from apps.chats.services import realtime
+from apps.chats.services.broadcaster import ConnectionSender
+from apps.chats.services.membership import UserContext
+from apps.chats.services.registry import ConnectionRecord
+
+
+class FakeWebSocket:
+    pass
+
+
+class RecordingWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+
+class FakeSender:
+    multiplexed = True
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(frame)
+        return True
+
+
+class FakeBus:
+    def __init__(self):
+        self.subscribed = set()
+
+    async def subscribe(self, channel_name):
+        self.subscribed.add(channel_name)
+
+    async def unsubscribe(self, channel_name):
+        self.subscribed.discard(channel_name)
+
+    async def publish(self, channel_name, event):
+        pass
+
+
+class FakeConsumers:
+    def __init__(self):
+        self.refs = {}
+
+    def acquire_channel(self, channel_name):
+        self.refs[channel_name] = self.refs.get(channel_name, 0) + 1
+
+    def release_channel(self, channel_name):
+        self.refs[channel_name] -= 1
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    bus, consumers = FakeBus(), FakeConsumers()
+    monkeypatch.setattr(realtime, "fanout_bus", bus)
+    monkeypatch.setattr(realtime, "consumer_registry", consumers)
+
+    async def activity(action, username, channel_name, current_time):
+        return {"id": str(uuid4()), "action": action, "username": username, "channel": channel_name,
+                "time": current_time, "sequence_number": 1}
+
+    async def share_history(channel_name, message_data):
+        pass
+
+    monkeypatch.setattr(realtime, "handle_user_activity", activity)
+    monkeypatch.setattr(realtime, "share_history", share_history)
+    return bus, consumers
+
+
+async def join(channel_name, username, bus, consumers):
+    """Подключение без проверок доступа: как в join_channel после них"""
+    user = UserContext(uuid4(), username, "user")
+    websocket, sender = FakeWebSocket(), FakeSender()
+    context = realtime.ChannelContext(channel_name, uuid4(), user, websocket, sender)
+    realtime.active_channels.add(channel_name, ConnectionRecord(user.id, username, websocket, sender))
+    await bus.subscribe(channel_name)
+    realtime.hot_tail.open(channel_name)
+    consumers.acquire_channel(channel_name)
+    return context
+
+
+@pytest.mark.asyncio
+async def test_kicked_member_is_cleaned_up_like_a_leave(channel):
+    bus, consumers = channel
+    channel_name = f"kick_{uuid4().hex}"
+    context = await join(channel_name, "mallory", bus, consumers)
+
+    await realtime.deliver_event(channel_name, {
+        "type": "kick", "username": "mallory", "user_id": str(context.user_id),
+        "chat_id": str(context.chat_id), "text": "kicked",
+    })
+
+    assert not context.is_active
+    assert channel_name not in bus.subscribed
+    assert channel_name in realtime.idle_channels
+    assert [frame.text for frame in context.sender.frames] == ["kicked"]
+
+    await realtime.leave_channel(context)
+    assert consumers.refs[channel_name] == 0
+    realtime.idle_channels.pop(channel_name, None)
+
+
+@pytest.mark.asyncio
+async def test_kick_and_broadcast_invalidate_membership_without_local_members():
+    user_id, chat_id = uuid4(), uuid4()
+    realtime.membership_cache.set_member(user_id, chat_id)
+
+    await realtime.deliver_event(f"kick_{uuid4().hex}", {
+        "type": "kick", "username": "mallory", "user_id": str(user_id), "chat_id": str(chat_id), "text": "kicked",
+    })
+    assert realtime.membership_cache.links.get((user_id, chat_id)) is not True
+
+    realtime.membership_cache.set_member(user_id, chat_id)
+    await realtime.fanout_bus.broadcast({"type": "invalidate_member", "user_id": str(user_id), "chat_id": str(chat_id)})
+    assert realtime.membership_cache.links.get((user_id, chat_id)) is not True
+
+
+def test_channel_name_limits_match_chat_name():
+    limit = ChatCreate.model_fields["name"].metadata[0].max_length
+    assert ChatMessageInDB.__table__.c.channel.type.length == limit
+
+    channel_name = "к" * limit
+    ChatCreate(id=uuid4(), name=channel_name)
+    ChatMessageHistory(id=uuid4(), action="message", username="alice", channel=channel_name,
+                       time=datetime.now(timezone.utc), sequence_number=1, message="hi")
+    with pytest.raises(ValidationError):
+        ChatCreate(id=uuid4(), name=channel_name + "к")
+
+    # Очередь канала и ключ маршрутизации брокера ограничены 255 байтами
+    assert len(f"{channel_name}_messages".encode()) <= 255
+
+
+@pytest.mark.asyncio
+async def test_long_channel_history_reaches_hot_tail(channel):
+    bus, consumers = channel
+    channel_name = "long_" + "x" * 95
+    context = await join(channel_name, "alice", bus, consumers)
+    published = {"id": uuid4(), "action": "message", "username": "alice", "channel": channel_name,
+                 "time": datetime.now(timezone.utc).isoformat(), "sequence_number": 7, "message": "hi"}
+
+    await realtime.deliver_event(channel_name, {"type": "frame", "text": "alice: hi",
+                                                "history": realtime.history_item(published)})
+
+    items, _ = realtime.hot_tail.latest(channel_name, 1)
+    assert (items[0].id, items[0].channel, items[0].sequence_number) == (published["id"], channel_name, 7)
+    assert [frame.text for frame in context.sender.frames] == ["alice: hi"]
+
+    await realtime.leave_channel(context)
+    realtime.idle_channels.pop(channel_name, None)
+
+
+@pytest.mark.asyncio
+async def test_live_frames_during_join_follow_history_without_repeats():
+    channel_name = f"join_{uuid4().hex}"
+    user = UserContext(uuid4(), "alice", "user")
+    websocket = RecordingWebSocket()
+    sender = ConnectionSender(websocket)
+    sender.start()
+    context = realtime.ChannelContext(channel_name, uuid4(), user, websocket, sender)
+
+    # Как join_channel: живые кадры задержаны, соединение уже в реестре канала
+    sender.hold(channel_name)
+    realtime.active_channels.add(channel_name, ConnectionRecord(user.id, user.username, websocket, sender))
+    realtime.hot_tail.open(channel_name)
+    realtime.hot_tail.merge(channel_name, [], complete=True)
+    for seq in (1, 2):
+        published = {"id": uuid4(), "action": "message", "username": "bob", "channel": channel_name,
+                     "time": datetime.now(timezone.utc).isoformat(), "sequence_number": seq, "message": f"m{seq}"}
+        await realtime.deliver_event(channel_name, {"type": "frame", "text": f"live m{seq}",
+                                                    "history": realtime.history_item(published)})
+    await realtime.deliver_event(channel_name, {"type": "frame", "text": "bob вошел в чат"})
+
+    await realtime.send_recent_history(context)
+    await asyncio.sleep(0.01)
+
+    assert [text.split("] ", 1)[-1] for text in websocket.sent] == ["bob: m1", "bob: m2", "bob вошел в чат"]
+
+    realtime.active_channels.remove(channel_name, websocket)
+    realtime.hot_tail.close(channel_name)
+    await sender.stop()
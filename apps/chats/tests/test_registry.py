@@ -0,0 +1,41 @@
+from uuid import uuid4
+
+from apps.chats.services.registry import ChannelRegistry, ConnectionRecord
+
+
+class FakeWebSocket:
+    pass
+
+
+def make_record(username: str, user_id=None) -> ConnectionRecord:
+    return ConnectionRecord(user_id or uuid4(), username, FakeWebSocket(), sender=None)
+
+
+def test_lookup_by_username_and_user_id():
+    registry = ChannelRegistry()
+    alice = make_record("alice")
+    alice_second_tab = make_record("alice", user_id=alice.user_id)
+    bob = make_record("bob")
+    for record in (alice, alice_second_tab, bob):
+        registry.add("general", record)
+
+    channel = registry.get("general")
+    assert set(channel.by_username("alice")) == {alice, alice_second_tab}
+    assert channel.by_user(bob.user_id) == (bob,)
+    assert len(channel.members()) == 3
+
+
+def test_snapshot_is_stable_while_members_leave():
+    registry = ChannelRegistry()
+    records = [make_record(f"user_{i}") for i in range(3)]
+    for record in records:
+        registry.add("general", record)
+
+    snapshot = registry.get("general").members()
+    for record in snapshot:
+        registry.remove("general", record.websocket)
+
+    assert snapshot == tuple(records)
+    assert "general" not in registry
+    assert registry.get("general") is None
+    assert registry.remove("general", records[0].websocket) is None
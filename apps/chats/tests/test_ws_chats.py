@@ -0,0 +1,75 @@
+import json
+from contextlib import asynccontextmanager
+from itertools import count
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from uuid import uuid4
+
+import pytest
+from fastapi.testclient import TestClient
+
+from apps.auth.services.dependencies import get_current_user_from_websocket
+from apps.chats.services import realtime
+from main import app
+
+
+@pytest.fixture
+def chat_room(monkeypatch):
+    """Канал с одним участником без БД и брокера: публикация выдает номера по порядку"""
+    user_id, channel_name = uuid4(), f"room_{uuid4().hex}"
+    users, chats = AsyncMock(), AsyncMock()
+    users.get_user_by_id.return_value = SimpleNamespace(id=user_id, username="alice", role="user")
+    chats.get_chat_by_name.return_value = SimpleNamespace(id=uuid4(), name=channel_name)
+    chats.get_user_chat_link.return_value = object()
+    sequence = count(1)
+
+    @asynccontextmanager
+    async def session():
+        yield None
+
+    async def send_message_to_queue(channel, data):
+        return dict(data, id=str(uuid4()), sequence_number=next(sequence))
+
+    async def handle_user_activity(action, username, channel, current_time):
+        return {"id": str(uuid4()), "action": action, "username": username, "channel": channel,
+                "time": current_time, "sequence_number": next(sequence)}
+
+    monkeypatch.setattr(realtime, "async_session", session)
+    monkeypatch.setattr(realtime, "UserService", lambda session: users)
+    monkeypatch.setattr(realtime, "ChatService", lambda session: chats)
+    monkeypatch.setattr(realtime, "send_message_to_queue", send_message_to_queue)
+    monkeypatch.setattr(realtime, "handle_user_activity", handle_user_activity)
+    app.dependency_overrides[get_current_user_from_websocket] = lambda: user_id
+    yield channel_name
+    app.dependency_overrides.pop(get_current_user_from_websocket, None)
+    realtime.idle_channels.pop(channel_name, None)
+
+
+def test_resume_from_sequence_number_of_live_frame(chat_room):
+    client = TestClient(app)
+    url = f"/chats/api/v1/ws/{chat_room}?envelope=true"
+
+    with client.websocket_connect(url) as first:
+        assert json.loads(first.receive_text())["text"].endswith("Вы вошли в чат")
+        frames = []
+        for text in ("m1", "m2", "m3"):
+            first.send_text(text)
+            frames.append(json.loads(first.receive_text()))
+        assert [frame["text"].split(": ", 1)[1] for frame in frames] == ["m1", "m2", "m3"]
+
+        last_seq = frames[0]["seq"]
+        with client.websocket_connect(f"{url}&last_seq={last_seq}") as second:
+            replay = [json.loads(second.receive_text()) for _ in range(2)]
+            assert [(frame["seq"], frame["id"]) for frame in replay] == [
+                (frame["seq"], frame["id"]) for frame in frames[1:]
+            ]
+            assert "seq" not in json.loads(second.receive_text())
+
+
+def test_multiplexed_subscribe_rejects_boolean_last_seq(chat_room):
+    client = TestClient(app)
+
+    with client.websocket_connect("/chats/api/v1/ws") as websocket:
+        websocket.send_text(json.dumps({"action": "subscribe", "channel": chat_room, "last_seq": True}))
+        assert json.loads(websocket.receive_text()) == {"channel": chat_room, "text": "Некорректный last_seq"}
+        assert chat_room not in realtime.active_channels
@@ -1,6 +1,6 @@
 from typing import Any
 
-from pydantic import field_validator
+from pydantic import field_validator, model_validator
 from pydantic.networks import PostgresDsn
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -50,10 +50,99 @@ class PostgresSettings(Base):
 class MQSettings(Base):
     broker_url: str | None = None
     queue_name: str = "chat_queue"
+    fanout_backend: str = "local"
+    fanout_exchange: str = "chat_fanout"
+    transport: str = "aio_pika"  # aio_pika - RabbitMQ; memory - брокер в памяти процесса для тестов и бенчмарков
+    topology: str = "per_channel"  # per_channel - очередь на канал; partitioned - партиции за topic-обменником
+    partitions: int = 16
+    topic_exchange: str = "chat_messages"
+    wire_format: str = "compact"  # compact - массив фиксированной схемы на orjson; json - прежний формат
+    ingest_in_web: bool = True  # False - сохранением сообщений занимается отдельный apps.mq.worker
+    worker_stats_interval: float = 30.0
+    buffer_max_messages: int = 20_000  # буфер записи в БД; при переполнении прием из очереди ждет
+    buffer_max_bytes: int = 32 * 1024 * 1024
+    flush_max_age: float = 1.0  # максимальное ожидание сообщения в буфере, с
+    flush_batch_min: int = 50
+    flush_batch_max: int = 5000
+    flush_target_latency: float = 0.25  # целевое время коммита пакета, с
+    consumer_prefetch: int | None = None  # None - доля буфера записи на партицию; у очередей каналов - flush_batch_min
+    persist_mode: str = "copy"  # copy - COPY через asyncpg; insert - многострочный INSERT; orm - session.add_all
+    dedup_window: int = 100_000  # id недавно записанных сообщений, повторные доставки которых отбрасываются до БД
+    queue_expires_ms: int | None = None  # x-expires для очередей каналов; None - очереди живут бессрочно
+    channel_pool_size: int = 8  # каналы объявлений и каналы публикаций (закреплены за каналами чата) поверх одного соединения
+    publisher_mode: str = "direct"  # direct - ожидание подтверждения каждой публикации; batched - конвейер
+    publisher_max_in_flight: int = 1000  # публикации, ожидающие подтверждения брокера
+    publisher_batch_size: int = 100
+    publisher_batch_window_ms: float = 5.0
+    publisher_stats_interval: float = 60.0
+
+    @field_validator("transport")
+    def check_transport(cls, value: str) -> str:
+        if value not in ("aio_pika", "memory"):
+            raise ValueError(f"Неизвестный транспорт брокера: {value}")
+        return value
+
+    @field_validator("topology")
+    def check_topology(cls, value: str) -> str:
+        if value not in ("per_channel", "partitioned"):
+            raise ValueError(f"Неизвестная топология очередей: {value}")
+        return value
+
+    @field_validator("wire_format")
+    def check_wire_format(cls, value: str) -> str:
+        if value not in ("compact", "json"):
+            raise ValueError(f"Неизвестный формат сообщений очереди: {value}")
+        return value
+
+    @field_validator("persist_mode")
+    def check_persist_mode(cls, value: str) -> str:
+        if value not in ("copy", "insert", "orm"):
+            raise ValueError(f"Неизвестный способ записи сообщений: {value}")
+        return value
+
+    @field_validator("publisher_mode")
+    def check_publisher_mode(cls, value: str) -> str:
+        if value not in ("direct", "batched"):
+            raise ValueError(f"Неизвестный режим издателя: {value}")
+        return value
 
     model_config = SettingsConfigDict(env_prefix="MQ_")
 
 
+class WebSocketSettings(Base):
+    send_queue_size: int = 256
+    backpressure_policy: str = "drop_oldest"
+    lag_disconnect_threshold: int | None = None
+    close_timeout: float = 5.0
+    membership_cache_ttl: float = 30.0
+    membership_cache_size: int = 100_000
+    idle_channel_ttl: float = 300.0
+    join_history_size: int = 20  # последние события, отправляемые соединению сразу после входа в канал
+    resume_max_replay: int = 200  # предел досылки пропущенного при переподключении с last_seq, не больше send_queue_size
+    reaper_interval: float = 60.0
+
+    @field_validator("backpressure_policy")
+    def check_backpressure_policy(cls, value: str) -> str:
+        if value not in ("drop_oldest", "coalesce", "disconnect"):
+            raise ValueError(f"Неизвестная политика backpressure: {value}")
+        return value
+
+    @model_validator(mode="after")
+    def check_queue_limits(self) -> "WebSocketSettings":
+        # Очередь обрезается на send_queue_size: порог выше нее недостижим, досылка больше нее не помещается
+        if self.lag_disconnect_threshold is not None and self.lag_disconnect_threshold > self.send_queue_size:
+            raise ValueError(
+                f"Порог отключения {self.lag_disconnect_threshold} больше размера очереди {self.send_queue_size}"
+            )
+        if self.resume_max_replay > self.send_queue_size:
+            raise ValueError(
+                f"Предел досылки {self.resume_max_replay} больше размера очереди {self.send_queue_size}"
+            )
+        return self
+
+    model_config = SettingsConfigDict(env_prefix="WS_")
+
+
 class AppSettings(Base):
     is_debug: bool | None = None
     log_level: str | None = None
@@ -82,12 +171,18 @@ class ChatsSettings(AppSettings):
     docs_version: str = version
     docs_name: str = "chats"
     docs_basic_credentials: str | None = None 
+    history_page_size: int = 50  # размер страницы истории по умолчанию
+    history_max_page_size: int = 500
+    history_tail_size: int = 100  # последние события канала в памяти процесса (горячий хвост)
+    history_tail_channels: int = 10_000
+    history_tail_max_bytes: int = 64 * 1024 * 1024
 
 
 class Settings(Base):
     app_settings: AppSettings = AppSettings()
     postgres_settings: PostgresSettings = PostgresSettings()
     mq_settings: MQSettings = MQSettings()
+    ws_settings: WebSocketSettings = WebSocketSettings()
     users_settings: UsersSettings = UsersSettings()
     auth_settings: AuthSettings = AuthSettings()
     chats_settings: ChatsSettings = ChatsSettings()
@@ -0,0 +1,338 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from uuid import UUID
+
+logger = logging.getLogger(__name__)
+
+BatchWriter = Callable[[List[dict]], Awaitable[None]]
+PersistedHook = Callable[[List[Any]], Awaitable[None]]
+ErrorFilter = Callable[[BaseException], bool]
+PendingKey = Tuple[int, float]
+
+
+def pending_key(message: dict) -> PendingKey:
+    """Порядок сообщений канала: sequence_number, при совпадении - id (как курсор истории)"""
+    message_id = message.get("id")
+    if message_id is None:
+        id_order = 0
+    else:
+        id_order = message_id.int if isinstance(message_id, UUID) else UUID(message_id).int
+    return message.get("sequence_number", 0), id_order
+
+
+class BufferedMessage:
+    """Сообщение, ожидающее записи в БД; receipt передается в on_persisted после коммита"""
+    __slots__ = ("data", "size", "receipt")
+
+    def __init__(self, data: dict, size: int, receipt: Any = None) -> None:
+        self.data = data
+        self.size = size
+        self.receipt = receipt
+
+
+class PendingIndex:
+    """Незаписанные сообщения одного канала, упорядоченные по pending_key
+
+    Сообщения приходят почти по порядку, поэтому вставка обычно - добавление в конец.
+    """
+    __slots__ = ("_keys", "_messages")
+
+    def __init__(self) -> None:
+        self._keys: List[PendingKey] = []
+        self._messages: List[dict] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, message: dict) -> None:
+        key = pending_key(message)
+        if not self._keys or key >= self._keys[-1]:
+            self._keys.append(key)
+            self._messages.append(message)
+            return
+
+        position = bisect_right(self._keys, key)
+        self._keys.insert(position, key)
+        self._messages.insert(position, message)
+
+    def discard(self, messages: List[dict]) -> None:
+        """Удаление записанных сообщений одним проходом"""
+        written = {id(message) for message in messages}
+        kept = [(key, message) for key, message in zip(self._keys, self._messages) if id(message) not in written]
+        self._keys = [key for key, _ in kept]
+        self._messages = [message for _, message in kept]
+
+    def range(
+        self,
+        after: Optional[PendingKey] = None,
+        before: Optional[PendingKey] = None,
+        limit: Optional[int] = None,
+        newest: bool = True,
+    ) -> List[dict]:
+        """Сообщения строго между after и before по возрастанию; с limit - ближайшие к before
+        (newest) или к after"""
+        start = bisect_right(self._keys, after) if after is not None else 0
+        end = bisect_left(self._keys, before) if before is not None else len(self._keys)
+        if limit is not None and end - start > limit:
+            if newest:
+                start = end - limit
+            else:
+                end = start + limit
+        return self._messages[start:end]
+
+
+class WriteBehindBuffer:
+    """Буфер отложенной записи сообщений по каналам
+
+    Ограничен числом сообщений и байтами: при переполнении put ждет освобождения
+    места. Сбрасывается одной фоновой задачей, когда накоплен пакет или самое старое
+    сообщение ждет дольше max_age. Перед записью накопленное подменяется пустым
+    буфером, поэтому сообщения, пришедшие во время записи, не теряются. Размер пакета
+    подстраивается под время коммита: растет, пока коммит быстрее target_latency,
+    и уменьшается, когда медленнее. Незаписанное после ошибки возвращается в начало
+    буфера и повторяется. Ошибка в данных (is_row_error) не повторяется: пакет делится
+    пополам, пока сообщения, которые не записываются и поодиночке, не будут найдены;
+    они удаляются из буфера, а их квитанции получает on_dead_letter. После коммита
+    каждого пакета on_persisted получает квитанции его сообщений (например, для
+    подтверждения доставки брокеру). Для чтения истории незаписанные сообщения
+    каждого канала индексируются по (sequence_number, id).
+    """
+    def __init__(
+        self,
+        writer: BatchWriter,
+        max_messages: int,
+        max_bytes: int,
+        max_age: float,
+        min_batch: int,
+        max_batch: int,
+        target_latency: float,
+        retry_delay: float = 1.0,
+        on_persisted: Optional[PersistedHook] = None,
+        on_dead_letter: Optional[PersistedHook] = None,
+        is_row_error: Optional[ErrorFilter] = None,
+    ) -> None:
+        self.writer = writer
+        self.on_persisted = on_persisted
+        self.on_dead_letter = on_dead_letter
+        self.is_row_error = is_row_error
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.target_latency = target_latency
+        self.retry_delay = retry_delay
+        self.batch_size = min_batch
+        self.commit_latency = 0.0
+        self.dead_lettered = 0
+
+        self._buffered: Dict[str, Deque[BufferedMessage]] = {}
+        self._flushing: Dict[str, Deque[BufferedMessage]] = {}
+        self._index: Dict[str, PendingIndex] = {}
+        self._buffered_count = 0
+        self._count = 0
+        self._bytes = 0
+        self._oldest: Optional[float] = None
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def start(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка фоновой задачи и запись всего накопленного"""
+        if self._flusher is not None:
+            # Текущая запись доводится до конца, задача снимается между сбросами
+            async with self._flush_lock:
+                self._flusher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flusher
+            self._flusher = None
+
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Не удалось записать {self._count} сообщений при остановке: {e}")
+
+    async def put(self, message: dict, size: int, receipt: Any = None) -> None:
+        """Добавление сообщения; ждет, пока буфер переполнен"""
+        self.start()
+        while self._count and (self._count >= self.max_messages or self._bytes + size > self.max_bytes):
+            self._space.clear()
+            self._wakeup.set()
+            await self._space.wait()
+
+        self._buffered.setdefault(message["channel"], deque()).append(BufferedMessage(message, size, receipt))
+        self._index.setdefault(message["channel"], PendingIndex()).add(message)
+        self._buffered_count += 1
+        self._count += 1
+        self._bytes += size
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+        if self._buffered_count >= self.batch_size or self._bytes >= self.max_bytes // 2:
+            self._wakeup.set()
+
+    def pending(
+        self,
+        channel_name: str,
+        after: Optional[PendingKey] = None,
+        before: Optional[PendingKey] = None,
+        limit: Optional[int] = None,
+        newest: bool = True,
+    ) -> List[dict]:
+        """Незаписанные сообщения канала, включая записываемые прямо сейчас, по возрастанию pending_key
+
+        Затрагивает только индекс этого канала; границы и limit - как у PendingIndex.range.
+        """
+        index = self._index.get(channel_name)
+        if index is None:
+            return []
+        return index.range(after, before, limit, newest)
+
+    def stats(self) -> dict:
+        return {
+            "buffered": self._buffered_count,
+            "flushing": self._count - self._buffered_count,
+            "bytes": self._bytes,
+            "batch_size": self.batch_size,
+            "commit_latency_ms": self.commit_latency * 1000,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    async def flush(self) -> int:
+        """Запись накопленного пакетами текущего размера; возвращает число записанных сообщений"""
+        async with self._flush_lock:
+            if not self._buffered_count:
+                return 0
+
+            self._flushing, self._buffered = self._buffered, {}
+            self._buffered_count = 0
+            self._oldest = None
+
+            written = 0
+            try:
+                while self._flushing:
+                    written += await self._write(self._take_chunk(self.batch_size))
+            except BaseException:
+                self._restore()
+                raise
+            finally:
+                self._space.set()
+
+            return written
+
+    async def _run(self) -> None:
+        while True:
+            if self._oldest is None:
+                timeout = self.max_age
+            else:
+                timeout = max(0.0, self._oldest + self.max_age - time.monotonic())
+
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            self._wakeup.clear()
+
+            if not self._buffered_count:
+                continue
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи буфера сообщений, повтор через {self.retry_delay} с: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+    async def _write(self, chunk: List[BufferedMessage]) -> int:
+        """Запись части буфера; при ошибке в данных - по половинам, до отдельных сообщений"""
+        started_at = time.monotonic()
+        try:
+            await self.writer([message.data for message in chunk])
+        except Exception as e:
+            if self.is_row_error is None or not self.is_row_error(e):
+                raise
+            if len(chunk) == 1:
+                logger.error(f"Сообщение канала {chunk[0].data.get('channel')} не может быть записано: {e}")
+                self._release(chunk)
+                self.dead_lettered += 1
+                await self._notify(self.on_dead_letter, chunk)
+                return 0
+
+            # Половины - тоже начала очередей каналов в _flushing, поэтому освобождаются по порядку
+            half = len(chunk) // 2
+            return await self._write(chunk[:half]) + await self._write(chunk[half:])
+
+        self._adapt(time.monotonic() - started_at, len(chunk))
+        self._release(chunk)
+        await self._notify(self.on_persisted, chunk)
+        return len(chunk)
+
+    async def _notify(self, hook: Optional[PersistedHook], chunk: List[BufferedMessage]) -> None:
+        if hook is None:
+            return
+
+        receipts = [message.receipt for message in chunk if message.receipt is not None]
+        if not receipts:
+            return
+
+        try:
+            await hook(receipts)
+        except Exception as e:
+            logger.error(f"Ошибка обработки записанного пакета: {e}")
+
+    def _take_chunk(self, size: int) -> List[BufferedMessage]:
+        """Начало записываемой части; сообщения канала идут подряд и по порядку.
+        Сообщения остаются в _flushing до успешной записи."""
+        chunk = []
+        for messages in self._flushing.values():
+            for message in messages:
+                if len(chunk) >= size:
+                    return chunk
+                chunk.append(message)
+        return chunk
+
+    def _release(self, chunk: List[BufferedMessage]) -> None:
+        written: Dict[str, List[dict]] = {}
+        for message in chunk:
+            channel_name = message.data["channel"]
+            messages = self._flushing[channel_name]
+            messages.popleft()
+            if not messages:
+                del self._flushing[channel_name]
+            written.setdefault(channel_name, []).append(message.data)
+            self._count -= 1
+            self._bytes -= message.size
+
+        for channel_name, messages in written.items():
+            index = self._index[channel_name]
+            index.discard(messages)
+            if not index:
+                del self._index[channel_name]
+
+    def _restore(self) -> None:
+        """Возврат незаписанного в начало буфера"""
+        for channel_name, messages in self._flushing.items():
+            buffered = self._buffered.get(channel_name)
+            if buffered:
+                messages.extend(buffered)
+            self._buffered[channel_name] = messages
+            self._buffered_count += len(messages)
+        self._flushing = {}
+        self._oldest = time.monotonic()
+
+    def _adapt(self, latency: float, chunk_size: int) -> None:
+        self.commit_latency = latency if not self.commit_latency else 0.8 * self.commit_latency + 0.2 * latency
+        if latency > self.target_latency:
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+        elif latency < self.target_latency / 2 and chunk_size >= self.batch_size:
+            self.batch_size = min(self.max_batch, self.batch_size * 2)
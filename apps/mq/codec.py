@@ -0,0 +1,86 @@
+import json
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+import orjson
+
+LEGACY_CONTENT_TYPE = "application/json"
+COMPACT_CONTENT_TYPE = "application/vnd.chat-event.v1+json"
+COMPACT_VERSION = 1
+
+
+class DecodeError(ValueError):
+    """Сообщение очереди в неизвестном или поврежденном формате"""
+
+
+def encode_event(message_data: dict, wire_format: str) -> Tuple[bytes, str]:
+    """Сериализация события канала; возвращает тело и content_type
+
+    Компактный формат - массив фиксированной схемы
+    [версия, action, username, время в мс, sequence_number, message, id];
+    канал не передается, он восстанавливается из ключа маршрутизации.
+    """
+    if wire_format == "json":
+        return json.dumps(message_data, ensure_ascii=False).encode("utf-8"), LEGACY_CONTENT_TYPE
+
+    message_id = message_data.get("id")
+    body = orjson.dumps([
+        COMPACT_VERSION,
+        message_data["action"],
+        message_data["username"],
+        _to_epoch_ms(message_data["time"]),
+        message_data["sequence_number"],
+        message_data.get("message"),
+        str(message_id) if message_id is not None else None,
+    ])
+    return body, COMPACT_CONTENT_TYPE
+
+
+def decode_event(body: bytes, content_type: Optional[str], channel_name: str) -> dict:
+    """Разбор события канала в любом из поддерживаемых форматов
+
+    Результат одинаков для обоих форматов: time - datetime в UTC, channel - из
+    сообщения (старый формат) или из ключа маршрутизации.
+    """
+    try:
+        if content_type == COMPACT_CONTENT_TYPE:
+            fields = orjson.loads(body)
+            if not isinstance(fields, list) or not fields or fields[0] != COMPACT_VERSION:
+                raise DecodeError("Неподдерживаемая версия компактного формата")
+            _, action, username, time_ms, sequence_number, message, message_id = fields
+            return {
+                "action": action,
+                "username": username,
+                "channel": channel_name,
+                "time": datetime.fromtimestamp(time_ms / 1000, tz=timezone.utc),
+                "sequence_number": sequence_number,
+                "message": message,
+                "id": message_id,
+            }
+
+        if not content_type or content_type == LEGACY_CONTENT_TYPE:
+            data = orjson.loads(body)
+            return {
+                "action": data["action"],
+                "username": data["username"],
+                "channel": data.get("channel") or channel_name,
+                "time": datetime.fromisoformat(data["time"]).replace(tzinfo=timezone.utc),
+                "sequence_number": data["sequence_number"],
+                "message": data.get("message"),
+                "id": data.get("id"),
+            }
+
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        if isinstance(e, DecodeError):
+            raise
+        raise DecodeError(f"Поврежденное сообщение: {e}") from e
+
+    raise DecodeError(f"Неизвестный формат сообщения: {content_type}")
+
+
+def _to_epoch_ms(value) -> int:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
@@ -1,21 +1,85 @@
+import asyncio
+import zlib
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
 import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractRobustConnection
+from aio_pika.pool import Pool
+
+from apps.core.config import settings
+
+
+def get_queue_arguments() -> dict | None:
+    """Аргументы объявления очередей каналов (одинаковые у издателя и потребителя)"""
+    if settings.mq_settings.queue_expires_ms:
+        return {"x-expires": settings.mq_settings.queue_expires_ms}
+    return None
 
 
 class RabbitMQConnectionManager:
-    """Инициализация и соединение с менеджером MQ"""
-    def __init__(self, broker_url: str):
+    """Инициализация и соединение с менеджером MQ
+
+    Пул каналов - для объявлений (канал занимается на время операции). Публикации
+    идут отдельным набором из channel_pool_size каналов с подтверждениями: канал
+    выбирается по ключу и не захватывается, поэтому публикации одного канала
+    конвейеризуются, а сообщения одного ключа всегда идут одним каналом AMQP по порядку.
+    """
+    def __init__(self, broker_url: str, channel_pool_size: int = 8):
         self.broker_url = broker_url
-        self.connection = None
-        self.channel = None
+        self.channel_pool_size = channel_pool_size
+        self.connection: Optional[AbstractRobustConnection] = None
+        self.channel: Optional[AbstractChannel] = None
+        self.channel_pool: Optional[Pool] = None
+        self._publish_channels: List[Optional[AbstractChannel]] = [None] * channel_pool_size
+        self._lock = asyncio.Lock()
+        self._publish_lock = asyncio.Lock()
 
     async def connect(self):
-        if not self.connection:
-            self.connection = await aio_pika.connect_robust(self.broker_url)
-            self.channel = await self.connection.channel()
+        async with self._lock:
+            if not self.connection:
+                self.connection = await aio_pika.connect_robust(self.broker_url)
+                self.channel = await self.connection.channel()
+                self.channel_pool = Pool(self._open_channel, max_size=self.channel_pool_size)
         return self.channel
 
+    async def _open_channel(self) -> AbstractChannel:
+        return await self.connection.channel(publisher_confirms=True)
+
+    @asynccontextmanager
+    async def acquire_channel(self) -> AsyncIterator[AbstractChannel]:
+        """Канал из пула; соединение поднимается при первом обращении"""
+        if self.channel_pool is None:
+            await self.connect()
+        async with self.channel_pool.acquire() as channel:
+            yield channel
+
+    async def publish_channel(self, key: str) -> AbstractChannel:
+        """Канал публикации для ключа (имени канала чата); открывается при первом обращении"""
+        if self.connection is None:
+            await self.connect()
+        index = zlib.crc32(key.encode("utf-8")) % len(self._publish_channels)
+        channel = self._publish_channels[index]
+        if channel is None or channel.is_closed:
+            async with self._publish_lock:
+                channel = self._publish_channels[index]
+                if channel is None or channel.is_closed:
+                    channel = self._publish_channels[index] = await self._open_channel()
+        return channel
+
     async def disconnect(self):
-        if self.connection:
-            await self.connection.close()
-            self.connection = None
-            self.channel = None
+        async with self._lock:
+            if self.channel_pool:
+                await self.channel_pool.close()
+                self.channel_pool = None
+            self._publish_channels = [None] * self.channel_pool_size
+            if self.connection:
+                await self.connection.close()
+                self.connection = None
+                self.channel = None
+
+
+rabbit_connection_manager = RabbitMQConnectionManager(
+    settings.mq_settings.broker_url,
+    channel_pool_size=settings.mq_settings.channel_pool_size,
+)
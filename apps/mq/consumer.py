@@ -1,103 +1,320 @@
 import asyncio
-import json
 import logging
-from datetime import datetime, timezone
+from collections import OrderedDict
+from contextlib import suppress
+from functools import partial
+from typing import Any, Dict, List, Set, Tuple
 
 import aio_pika
 
-from apps.chats.models.chats import ChatMessageInDB
 from apps.core.config import settings
-from apps.db import get_session
-from apps.mq.connection import RabbitMQConnectionManager
+from apps.mq.buffer import WriteBehindBuffer
+from apps.mq.codec import DecodeError, decode_event
+from apps.mq.persistence import get_batch_writer, is_row_error
+from apps.mq.topology import topology
+from apps.mq.transport import TransportError, transport
 
 logger = logging.getLogger(__name__)
 
-MAX_BATCH_SIZE = 100  # Максимальный размер пакета
-FLUSH_INTERVAL = 30  # Интервал сброса в секундах
-message_buffer = []  # Буфер для сообщений
 
-rabbit_connection_manager = RabbitMQConnectionManager(settings.mq_settings.broker_url)
+class IngestStats:
+    """Счетчики приема и сохранения сообщений процессом"""
+    def __init__(self) -> None:
+        self.received = 0
+        self.persisted = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.dead_lettered = 0
 
-async def save_message_batch_to_db(batch_data: list, session):
-    """
-    Сохраняет пакет сообщений в базу данных.
-    """
-    try:
-        session.add_all(batch_data)
-        await session.commit()
-        logger.debug(f"Batch of {len(batch_data)} messages saved to DB.")
-    except Exception as e:
-        logger.error(f"Error saving batch to DB: {e}")
-        await session.rollback()
-        raise e
 
-async def flush_message_buffer():
-    global message_buffer
-    if not message_buffer:
-        return
+ingest_stats = IngestStats()
+batch_writer = get_batch_writer(settings.mq_settings.persist_mode)
 
+
+async def persist_messages(messages: List[dict]) -> None:
+    """Запись пакета сообщений из буфера в БД"""
     try:
-        async for session in get_session():
-            valid_messages = [
-                ChatMessageInDB(
-                    action=msg["action"],
-                    username=msg["username"],
-                    channel=msg["channel"],
-                    time=datetime.fromisoformat(msg["time"]).replace(tzinfo=timezone.utc),
-                    sequence_number=msg["sequence_number"],
-                    message=msg.get("message") or "No message"
-                )
-                for msg in message_buffer
-            ]
-
-            if valid_messages:
-                await save_message_batch_to_db(valid_messages, session)
-                
-            message_buffer.clear()
+        await batch_writer(messages)
+        ingest_stats.persisted += len(messages)
 
     except Exception as e:
-        logger.error(f"Ошибка очистки буфера сообщений: {e}")
+        ingest_stats.failed += len(messages)
+        logger.error(f"Ошибка записи пакета сообщений: {e}")
         raise
 
-async def on_message(message):
-    """Прием сообщения из очереди"""
-    global message_buffer
-    async with message.process():
-        try:
-  
-            message_data = json.loads(message.body.decode("utf-8"))
-            logger.debug(f"Получено сообщение: {message_data}")
 
-            message_buffer.append(message_data)
+class RecentIds:
+    """Ограниченное окно id недавно записанных сообщений (LRU)
 
-            if len(message_buffer) >= MAX_BATCH_SIZE:
-                await flush_message_buffer()
+    Повторная доставка уже записанного сообщения подтверждается сразу, без
+    обращения к БД; все, что выпало из окна, отсеивает ON CONFLICT (id) при записи.
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
 
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка при декодировании сообщения: {e}")
-            raise
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка обработки сообщения: {e}")
-            raise
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._ids
 
-async def start_consumer(queue_name: str):
-    """Запуск consumer"""
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, message_id: str) -> None:
+        self._ids[message_id] = None
+        self._ids.move_to_end(message_id)
+        while len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+
+recent_ids = RecentIds(settings.mq_settings.dedup_window)
+
+
+class DeliveryAcks:
+    """Подтверждения доставок одного потребителя (канала брокера)
+
+    Сообщение подтверждается только после коммита его пакета, одним multiple-ack
+    на самый старший тег непрерывного префикса обработанных доставок: теги
+    одного канала брокера подтверждаются по порядку, а пакеты записываются
+    вперемешку по каналам чата.
+    """
+    def __init__(self) -> None:
+        self._pending: "OrderedDict[int, Any]" = OrderedDict()
+        self._persisted: Set[int] = set()
+        self._rejected: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def delivered(self, message) -> None:
+        self._pending[message.delivery_tag] = message
+
+    def persisted(self, delivery_tag: int) -> None:
+        self._persisted.add(delivery_tag)
+
+    async def reject(self, message) -> None:
+        """Отказ без возврата в очередь для сообщения, которое невозможно сохранить"""
+        self._rejected.add(message.delivery_tag)
+        await message.reject(requeue=False)
+
+    async def reject_tag(self, delivery_tag: int) -> None:
+        message = self._pending.get(delivery_tag)
+        if message is not None:
+            await self.reject(message)
+
+    async def flush(self) -> None:
+        """multiple-ack до последней записанной доставки непрерывного префикса"""
+        last_persisted = None
+        while self._pending:
+            delivery_tag, message = next(iter(self._pending.items()))
+            if delivery_tag in self._persisted:
+                self._persisted.discard(delivery_tag)
+                last_persisted = message
+            elif delivery_tag in self._rejected:
+                self._rejected.discard(delivery_tag)
+            else:
+                break
+            del self._pending[delivery_tag]
+
+        if last_persisted is not None:
+            await last_persisted.ack(multiple=True)
+
+
+async def acknowledge_persisted(receipts: List[Tuple[DeliveryAcks, int, str | None]]) -> None:
+    """Подтверждение брокеру сообщений записанного пакета"""
+    consumers: Dict[int, DeliveryAcks] = {}
+    for acks, delivery_tag, message_id in receipts:
+        acks.persisted(delivery_tag)
+        consumers[id(acks)] = acks
+        if message_id is not None:
+            recent_ids.add(message_id)
+
+    for acks in consumers.values():
+        await acks.flush()
+
+
+async def reject_unwritable(receipts: List[Tuple[DeliveryAcks, int, str | None]]) -> None:
+    """Отказ брокеру в сообщениях, которые не записываются в БД даже поодиночке
+
+    Брокер удаляет их из очереди или, если политикой очереди задан dead-letter
+    exchange, перекладывает туда; подтверждения следующих сообщений не задерживаются.
+    """
+    consumers: Dict[int, DeliveryAcks] = {}
+    for acks, delivery_tag, message_id in receipts:
+        logger.error(f"Сообщение {message_id} отклонено: не может быть записано в БД")
+        ingest_stats.dead_lettered += 1
+        await acks.reject_tag(delivery_tag)
+        consumers[id(acks)] = acks
+
+    for acks in consumers.values():
+        await acks.flush()
+
+
+message_buffer = WriteBehindBuffer(
+    persist_messages,
+    max_messages=settings.mq_settings.buffer_max_messages,
+    max_bytes=settings.mq_settings.buffer_max_bytes,
+    max_age=settings.mq_settings.flush_max_age,
+    min_batch=settings.mq_settings.flush_batch_min,
+    max_batch=settings.mq_settings.flush_batch_max,
+    target_latency=settings.mq_settings.flush_target_latency,
+    on_persisted=acknowledge_persisted,
+    on_dead_letter=reject_unwritable,
+    is_row_error=is_row_error,
+)
+
+
+def get_prefetch_count(consumers: int | None = None) -> int:
+    """Prefetch потребителя - фиксированная доля буфера записи
+
+    consumers - число постоянных потребителей процесса (очередей-партиций): их доли
+    в сумме равны емкости буфера. Потребителей очередей каналов столько, сколько
+    активных каналов, поэтому их доля не зависит от порядка запуска и равна
+    минимальному пакету записи; неподтвержденных доставок тогда не больше числа
+    каналов на эту долю, а доставки сверх свободного места в буфере ждут в put.
+    """
+    if settings.mq_settings.consumer_prefetch:
+        return settings.mq_settings.consumer_prefetch
+    if consumers is None:
+        return settings.mq_settings.flush_batch_min
+    return max(settings.mq_settings.flush_batch_min, settings.mq_settings.buffer_max_messages // max(1, consumers))
+
+
+async def on_message(message, acks: DeliveryAcks):
+    """Прием сообщения из очереди в буфер записи; подтверждение - после записи в БД"""
+    acks.delivered(message)
     try:
-        connection = await aio_pika.connect_robust(settings.mq_settings.broker_url)
-        async with connection:
-            channel = await connection.channel()
+        message_data = decode_event(
+            message.body, message.content_type, topology.channel_name(message.routing_key)
+        )
+        logger.debug(f"Получено сообщение: {message_data}")
+        ingest_stats.received += 1
 
-            queue = await channel.declare_queue(queue_name, durable=True)
+        message_id = message_data.get("id")
+        if message_id is not None and message_id in recent_ids:
+            # Повторная доставка уже записанного сообщения (например, после обрыва до подтверждения)
+            ingest_stats.duplicates += 1
+            acks.persisted(message.delivery_tag)
+            await acks.flush()
+            return
 
-            logger.info(f"Очередь '{queue_name}' готова. Ожидаются сообщения...")
+        await message_buffer.put(message_data, len(message.body), receipt=(acks, message.delivery_tag, message_id))
 
-            await queue.consume(on_message, no_ack=False)
-            while True:
-                await asyncio.sleep(FLUSH_INTERVAL)
-                await flush_message_buffer()
+    except DecodeError as e:
+        logger.error(f"Ошибка при декодировании сообщения: {e}")
+        await acks.reject(message)
+        await acks.flush()
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка обработки сообщения: {e}")
+        await acks.reject(message)
+        await acks.flush()
+        raise
 
-    except aio_pika.exceptions.AMQPChannelError as e:
+async def start_consumer(queue_name: str, prefetch_count: int = 0):
+    """Запуск consumer"""
+    try:
+        await topology.declare_queue(transport, queue_name)
+
+        logger.info(f"Очередь '{queue_name}' готова. Ожидаются сообщения...")
+
+        acks = DeliveryAcks()
+        consumer_tag = await transport.consume(queue_name, partial(on_message, acks=acks), prefetch_count=prefetch_count)
+        try:
+            await asyncio.Future()
+        except asyncio.CancelledError:
+            logger.info(f"Потребитель очереди '{queue_name}' остановлен")
+            # Подтвердить можно только через канал этого потребителя, поэтому буфер записывается до его закрытия
+            if len(acks):
+                with suppress(Exception):
+                    await message_buffer.flush()
+            await transport.cancel(consumer_tag)
+            raise
+
+    except (aio_pika.exceptions.AMQPChannelError, TransportError) as e:
         logger.error(f"Ошибка канала при настройке потребителя для очереди '{queue_name}': {e}")
     except Exception as e:
         logger.error(f"Ошибка при настройке очереди потребителя '{queue_name}': {e}")
-        raise e
\ No newline at end of file
+        raise e
+
+
+class ConsumerRegistry:
+    """Не более одного потребителя на очередь в процессе, с учетом ссылок от участников каналов
+
+    Потребитель без ссылок продолжает работать, пока его не закроет сборщик простаивающих каналов.
+    С ingest=False процесс не принимает сообщения на сохранение (этим занимается apps.mq.worker).
+    """
+    def __init__(self, ingest: bool = True) -> None:
+        self.ingest = ingest
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._refs: Dict[str, int] = {}
+
+    def acquire(self, queue_name: str, prefetch_count: int | None = None) -> None:
+        """Запуск потребителя очереди, если он еще не запущен"""
+        self._refs[queue_name] = self._refs.get(queue_name, 0) + 1
+
+        task = self._tasks.get(queue_name)
+        if task is None or task.done():
+            if prefetch_count is None:
+                prefetch_count = get_prefetch_count()
+            self._tasks[queue_name] = asyncio.create_task(start_consumer(queue_name, prefetch_count))
+
+    def release(self, queue_name: str) -> None:
+        """Снятие ссылки участника канала"""
+        refs = self._refs.get(queue_name, 0) - 1
+        if refs > 0:
+            self._refs[queue_name] = refs
+        else:
+            self._refs.pop(queue_name, None)
+
+    async def close(self, queue_name: str) -> None:
+        """Остановка потребителя, если на очередь больше никто не ссылается"""
+        if self._refs.get(queue_name):
+            return
+
+        task = self._tasks.pop(queue_name, None)
+        if task is not None:
+            await self._cancel(task)
+
+    def acquire_channel(self, channel_name: str) -> None:
+        """Ссылка участника канала на потребителя его очереди, если топология его требует"""
+        queue_name = topology.consumer_queue(channel_name)
+        if queue_name is not None and self.ingest:
+            self.acquire(queue_name)
+
+    def release_channel(self, channel_name: str) -> None:
+        queue_name = topology.consumer_queue(channel_name)
+        if queue_name is not None and self.ingest:
+            self.release(queue_name)
+
+    async def close_channel(self, channel_name: str) -> None:
+        queue_name = topology.consumer_queue(channel_name)
+        if queue_name is not None:
+            await self.close(queue_name)
+
+    def start_partitions(self, workers: int = 1, index: int = 0) -> List[str]:
+        """Постоянные потребители очередей-партиций; сборщик каналов их не останавливает"""
+        if not self.ingest:
+            return []
+
+        queue_names = topology.partition_queues(workers, index)
+        prefetch_count = get_prefetch_count(len(queue_names))
+        for queue_name in queue_names:
+            self.acquire(queue_name, prefetch_count)
+        return queue_names
+
+    async def stop(self) -> None:
+        """Остановка всех потребителей процесса и запись буфера"""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        self._refs.clear()
+        for task in tasks:
+            await self._cancel(task)
+        await message_buffer.stop()
+
+    @staticmethod
+    async def _cancel(task: asyncio.Task) -> None:
+        task.cancel()
+        with suppress(asyncio.CancelledError, Exception):
+            await task
+
+
+consumer_registry = ConsumerRegistry(ingest=settings.mq_settings.ingest_in_web)
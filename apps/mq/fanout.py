@@ -0,0 +1,162 @@
+import json
+import logging
+from typing import Awaitable, Callable, Optional
+from uuid import uuid4
+
+import aio_pika
+
+from apps.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[str, dict], Awaitable[None]]
+BroadcastHandler = Callable[[dict], Awaitable[None]]
+
+
+class LocalFanoutBus:
+    """Шина рассылки в пределах одного процесса"""
+    def __init__(self) -> None:
+        self.node_id = uuid4().hex
+        self._handler: Optional[EventHandler] = None
+        self._broadcast_handler: Optional[BroadcastHandler] = None
+
+    def on_event(self, handler: EventHandler) -> None:
+        """Регистрация обработчика, доставляющего событие локальным сокетам"""
+        self._handler = handler
+
+    def on_broadcast(self, handler: BroadcastHandler) -> None:
+        """Регистрация обработчика событий для всех процессов, независимо от их каналов"""
+        self._broadcast_handler = handler
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def subscribe(self, channel_name: str) -> None:
+        pass
+
+    async def unsubscribe(self, channel_name: str) -> None:
+        pass
+
+    async def publish(self, channel_name: str, event: dict) -> None:
+        """Доставка события локальным участникам канала"""
+        if self._handler is not None:
+            await self._handler(channel_name, event)
+
+    async def broadcast(self, event: dict) -> None:
+        """Доставка события этому процессу"""
+        if self._broadcast_handler is not None:
+            await self._broadcast_handler(event)
+
+
+class RabbitMQFanoutBus(LocalFanoutBus):
+    """Шина рассылки между воркерами и узлами через RabbitMQ
+
+    Каждый воркер держит эксклюзивную очередь, привязанную к обменнику
+    только по тем каналам, в которых у него есть локальные участники, и
+    к fanout-обменнику {exchange_name}.broadcast для событий всех воркеров.
+    """
+    def __init__(self, broker_url: str, exchange_name: str) -> None:
+        super().__init__()
+        self.broker_url = broker_url
+        self.exchange_name = exchange_name
+        self._connection = None
+        self._exchange = None
+        self._broadcast_exchange = None
+        self._queue = None
+
+    @property
+    def broadcast_exchange_name(self) -> str:
+        return f"{self.exchange_name}.broadcast"
+
+    async def start(self) -> None:
+        self._connection = await aio_pika.connect_robust(self.broker_url)
+        channel = await self._connection.channel()
+        self._exchange = await channel.declare_exchange(self.exchange_name, aio_pika.ExchangeType.DIRECT)
+        self._broadcast_exchange = await channel.declare_exchange(
+            self.broadcast_exchange_name, aio_pika.ExchangeType.FANOUT
+        )
+        self._queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        await self._queue.bind(self._broadcast_exchange)
+        await self._queue.consume(self._on_message, no_ack=True)
+        logger.info(f"Шина рассылки запущена, узел {self.node_id}")
+
+    async def stop(self) -> None:
+        if self._connection:
+            await self._connection.close()
+        self._connection = None
+        self._exchange = None
+        self._broadcast_exchange = None
+        self._queue = None
+
+    async def subscribe(self, channel_name: str) -> None:
+        if self._queue is not None:
+            await self._queue.bind(self._exchange, routing_key=channel_name)
+
+    async def unsubscribe(self, channel_name: str) -> None:
+        if self._queue is not None:
+            await self._queue.unbind(self._exchange, routing_key=channel_name)
+
+    async def publish(self, channel_name: str, event: dict) -> None:
+        """Локальная доставка и ретрансляция события остальным воркерам"""
+        await super().publish(channel_name, event)
+
+        if self._exchange is None:
+            return
+
+        try:
+            await self._exchange.publish(self._message(event), routing_key=channel_name)
+        except Exception as e:
+            logger.error(f"Ошибка ретрансляции события канала {channel_name}: {e}")
+
+    async def broadcast(self, event: dict) -> None:
+        """Локальная доставка и ретрансляция события всем воркерам"""
+        await super().broadcast(event)
+
+        if self._broadcast_exchange is None:
+            return
+
+        try:
+            await self._broadcast_exchange.publish(self._message(event), routing_key="")
+        except Exception as e:
+            logger.error(f"Ошибка ретрансляции события всем воркерам: {e}")
+
+    def _message(self, event: dict) -> aio_pika.Message:
+        return aio_pika.Message(
+            body=json.dumps(event, ensure_ascii=False).encode("utf-8"),
+            content_type="application/json",
+            headers={"origin": self.node_id},
+        )
+
+    async def _on_message(self, message: aio_pika.abc.AbstractIncomingMessage) -> None:
+        if message.headers.get("origin") == self.node_id:
+            return
+
+        try:
+            event = json.loads(message.body.decode("utf-8"))
+        except json.JSONDecodeError as e:
+            logger.error(f"Ошибка декодирования события шины: {e}")
+            return
+
+        if message.exchange == self.broadcast_exchange_name:
+            try:
+                await super().broadcast(event)
+            except Exception as e:
+                logger.error(f"Ошибка доставки события всем воркерам: {e}")
+            return
+
+        try:
+            await super().publish(message.routing_key, event)
+        except Exception as e:
+            logger.error(f"Ошибка доставки события канала {message.routing_key}: {e}")
+
+
+def get_fanout_bus() -> LocalFanoutBus:
+    if settings.mq_settings.fanout_backend == "rabbitmq":
+        return RabbitMQFanoutBus(settings.mq_settings.broker_url, settings.mq_settings.fanout_exchange)
+    return LocalFanoutBus()
+
+
+fanout_bus: LocalFanoutBus = get_fanout_bus()
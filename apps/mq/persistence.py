@@ -0,0 +1,168 @@
+import logging
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+from uuid import UUID, uuid4
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+# Модели всех приложений, как в alembic/env.py: связь ChatInDB.users ссылается на UserInDB по имени
+import apps.auth.models  # noqa: F401
+import apps.users.models  # noqa: F401
+from apps.chats.models.chats import ChatInDB, ChatMessageInDB
+from apps.db import engine, get_session
+from apps.mq.buffer import BatchWriter
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_COLUMNS = (
+    "id", "action", "username", "channel", "time",
+    "sequence_number", "message", "created_at", "updated_at",
+)
+EMPTY_MESSAGE = "No message"
+STAGING_TABLE = "chat_messages_staging"
+ROW_ERROR_SQLSTATE_CLASSES = ("22", "23")  # data exception, integrity constraint violation
+
+
+async def save_message_batch_to_db(batch_data: list, session):
+    """
+    Сохраняет пакет сообщений в базу данных.
+    """
+    try:
+        session.add_all(batch_data)
+        await session.commit()
+        logger.debug(f"Batch of {len(batch_data)} messages saved to DB.")
+    except Exception as e:
+        logger.error(f"Error saving batch to DB: {e}")
+        await session.rollback()
+        raise e
+
+
+def message_id(msg: dict) -> UUID:
+    """id сообщения, присвоенный при публикации; для сообщений без id (старые издатели) - новый"""
+    value = msg.get("id")
+    if value is None:
+        return uuid4()
+    return value if isinstance(value, UUID) else UUID(value)
+
+
+def is_row_error(error: BaseException) -> bool:
+    """Ошибка в данных сообщений пакета, а не в БД или соединении: повтор того же пакета ее не исправит
+
+    Это ошибки разбора сообщения (ValueError, TypeError, KeyError) и ошибки PostgreSQL
+    классов 22 и 23, например значение длиннее колонки; asyncpg передает SQLSTATE
+    в sqlstate, SQLAlchemy - в sqlstate исходной ошибки (orig).
+    """
+    if isinstance(error, (ValueError, TypeError, KeyError)):
+        return True
+    sqlstate = getattr(error, "sqlstate", None) or getattr(getattr(error, "orig", None), "sqlstate", None)
+    return isinstance(sqlstate, str) and sqlstate[:2] in ROW_ERROR_SQLSTATE_CLASSES
+
+
+def message_records(messages: List[dict]) -> List[Tuple]:
+    """Строки таблицы chat_messages в порядке MESSAGE_COLUMNS прямо из разобранных сообщений"""
+    now = datetime.now(timezone.utc)
+    return [
+        (
+            message_id(msg),
+            msg["action"],
+            msg["username"],
+            msg["channel"],
+            msg["time"],
+            msg["sequence_number"],
+            msg.get("message") or EMPTY_MESSAGE,
+            now,
+            now,
+        )
+        for msg in messages
+    ]
+
+
+async def load_chat_ids(connection, channels: Iterable[str]) -> Dict[str, UUID]:
+    """id чатов каналов пакета; канал без чата остается без chat_id"""
+    result = await connection.execute(select(ChatInDB.id, ChatInDB.name).where(ChatInDB.name.in_(set(channels))))
+    return {name: chat_id for chat_id, name in result}
+
+
+async def write_messages_orm(messages: List[dict]) -> None:
+    """Запись через ORM: модель и unit of work на каждую строку; уже сохраненные id пропускаются"""
+    ids = {message_id(msg): msg for msg in messages}
+    async for session in get_session():
+        existing = await session.execute(select(ChatMessageInDB.id).where(ChatMessageInDB.id.in_(list(ids))))
+        for (msg_id,) in existing:
+            ids.pop(msg_id, None)
+        chat_ids = await load_chat_ids(session, (msg["channel"] for msg in ids.values()))
+
+        valid_messages = [
+            ChatMessageInDB(
+                id=msg_id,
+                action=msg["action"],
+                username=msg["username"],
+                channel=msg["channel"],
+                chat_id=chat_ids.get(msg["channel"]),
+                time=msg["time"],
+                sequence_number=msg["sequence_number"],
+                message=msg.get("message") or EMPTY_MESSAGE
+            )
+            for msg_id, msg in ids.items()
+        ]
+        await save_message_batch_to_db(valid_messages, session)
+
+
+async def write_messages_insert(messages: List[dict]) -> None:
+    """Запись многострочным INSERT ... ON CONFLICT DO NOTHING без ORM-объектов"""
+    rows = [dict(zip(MESSAGE_COLUMNS, record)) for record in message_records(messages)]
+    async with engine.begin() as connection:
+        chat_ids = await load_chat_ids(connection, (row["channel"] for row in rows))
+        for row in rows:
+            row["chat_id"] = chat_ids.get(row["channel"])
+        await connection.execute(
+            insert(ChatMessageInDB.__table__).on_conflict_do_nothing(index_elements=["id"]),
+            rows,
+        )
+
+
+async def write_messages_copy(messages: List[dict]) -> None:
+    """Запись через COPY (asyncpg copy_records_to_table) в отдельной транзакции
+
+    COPY не поддерживает ON CONFLICT, поэтому пакет копируется во временную
+    таблицу соединения и переносится в chat_messages одним INSERT ... SELECT,
+    пропускающим уже сохраненные id и проставляющим chat_id по имени канала.
+    """
+    table = ChatMessageInDB.__table__
+    chats = ChatInDB.__table__
+    target = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    chats_table = f'"{chats.schema}"."{chats.name}"' if chats.schema else f'"{chats.name}"'
+    columns = ", ".join(MESSAGE_COLUMNS)
+    staged_columns = ", ".join(f"s.{column}" for column in MESSAGE_COLUMNS)
+    records = message_records(messages)
+    async with engine.connect() as connection:
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+        async with driver_connection.transaction():
+            await driver_connection.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} "
+                f"(LIKE {target} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+            )
+            await driver_connection.copy_records_to_table(
+                STAGING_TABLE,
+                columns=MESSAGE_COLUMNS,
+                records=records,
+            )
+            await driver_connection.execute(
+                f"INSERT INTO {target} ({columns}, chat_id) "
+                f"SELECT {staged_columns}, c.id FROM {STAGING_TABLE} AS s "
+                f"LEFT JOIN {chats_table} AS c ON c.name = s.channel "
+                f"ON CONFLICT (id) DO NOTHING"
+            )
+
+
+BATCH_WRITERS = {
+    "orm": write_messages_orm,
+    "insert": write_messages_insert,
+    "copy": write_messages_copy,
+}
+
+
+def get_batch_writer(persist_mode: str) -> BatchWriter:
+    return BATCH_WRITERS[persist_mode]
@@ -1,61 +1,366 @@
-import json
+import asyncio
 import logging
+import time
 from collections import defaultdict
+from contextlib import suppress
+from functools import partial
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
 
-import aio_pika
 from aio_pika import Message
+from sqlalchemy import select, update
 
+from apps.chats.models.chats import ChatInDB
 from apps.core.config import settings
+from apps.db import async_session
+from apps.mq.codec import encode_event
+from apps.mq.topology import PerChannelTopology, Route, topology
+from apps.mq.transport import Transport, transport
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-message_sequence = defaultdict(int)
+# Последний известный процессу номер канала: выданный им самим или пришедший из шины рассылки
+last_sequence_numbers: Dict[str, int] = {}
 
-async def publish_message_to_queue(queue_name: str, message_data: dict):
-    """Публикация сообщения в очередь"""
-    try:
-        logger.info(f"Попытка публикации сообщения в очередь {queue_name}: {message_data}")
-        sequence_number = message_sequence[queue_name]
-        message_sequence[queue_name] += 1
 
-        message_data['sequence_number'] = sequence_number
-        message_body = json.dumps(message_data, ensure_ascii=False).encode('utf-8')
-        
-        logger.debug(f"Сериализованное сообщение: {message_body}")
+async def next_sequence_number(channel_name: str) -> int:
+    """Следующий номер сообщения канала из счетчика его чата в БД
+
+    Счетчик один на все процессы и переживает перезапуски; UPDATE ... RETURNING
+    блокирует строку чата до коммита, поэтому номера канала выдаются по очереди
+    и не повторяются. Номер сообщения, которое потом не удалось опубликовать,
+    остается пропуском: история и горячий хвост пропуски допускают.
+    """
+    chats = ChatInDB.__table__
+    async with async_session() as session:
+        result = await session.execute(
+            update(chats)
+            .where(chats.c.name == channel_name)
+            .values(last_sequence_number=chats.c.last_sequence_number + 1)
+            .returning(chats.c.last_sequence_number)
+        )
+        sequence_number = result.scalar()
+        if sequence_number is None:
+            raise ValueError(f"Чат {channel_name} не найден")
+        await session.commit()
+    note_sequence_number(channel_name, sequence_number)
+    return sequence_number
+
+
+def note_sequence_number(channel_name: str, sequence_number: int) -> None:
+    """Учет номера, выданного счетчиком или увиденного в событии канала"""
+    if sequence_number > last_sequence_numbers.get(channel_name, 0):
+        last_sequence_numbers[channel_name] = sequence_number
+
+
+def forget_sequence_number(channel_name: str) -> None:
+    """Процесс больше не видит события канала - известный номер может устареть"""
+    last_sequence_numbers.pop(channel_name, None)
+
+
+async def current_sequence_number(channel_name: str) -> int:
+    """Последний номер канала без выдачи нового - для событий входа, выхода и модерации
+
+    Такие события не рассылаются как сообщения и не досылаются по last_seq, им
+    достаточно места в истории после последнего сообщения. Номер берется из
+    известных процессу, иначе - одним чтением счетчика без блокировки строки.
+    """
+    if channel_name not in last_sequence_numbers:
+        chats = ChatInDB.__table__
+        async with async_session() as session:
+            result = await session.execute(
+                select(chats.c.last_sequence_number).where(chats.c.name == channel_name)
+            )
+            sequence_number = result.scalar()
+        if sequence_number is None:
+            raise ValueError(f"Чат {channel_name} не найден")
+        note_sequence_number(channel_name, sequence_number)
+    return last_sequence_numbers.get(channel_name, 0)
+
+
+class Publisher:
+    """Долгоживущий издатель поверх транспорта брокера с кэшем объявлений очередей
+
+    Объявления разных очередей не ждут друг друга; запись об очереди канала
+    удаляется, когда сборщик простаивающих каналов освобождает канал.
+    """
+    def __init__(self, transport: Transport, topology: PerChannelTopology) -> None:
+        self.transport = transport
+        self.topology = topology
+        self._declared: Dict[str, float] = {}
+        self._declare_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    def _declaration_ttl(self) -> float:
+        # Очередь с x-expires удаляется брокером, поэтому объявление периодически повторяется
+        if settings.mq_settings.queue_expires_ms:
+            return settings.mq_settings.queue_expires_ms / 2000
+        return float("inf")
+
+    def _is_declared(self, queue_name: str) -> bool:
+        expires_at = self._declared.get(queue_name)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    async def _declare(self, route: Route) -> None:
+        queue_name = route.queue_name
+        if self._is_declared(queue_name):
+            return
+
+        async with self._declare_locks[queue_name]:
+            if not self._is_declared(queue_name):
+                await self.topology.declare_queue(self.transport, queue_name)
+                logger.debug(f"Очередь {queue_name} связана с обменником '{route.exchange_name}'")
+                self._declared[queue_name] = time.monotonic() + self._declaration_ttl()
+        self._declare_locks.pop(queue_name, None)
+
+    def forget(self, queue_name: str) -> None:
+        """Сброс кэша объявления, например после удаления очереди"""
+        self._declared.pop(queue_name, None)
+
+    def forget_channel(self, channel_name: str) -> None:
+        """Сброс кэша объявления очереди освобожденного канала; общие очереди-партиции остаются"""
+        queue_name = self.topology.consumer_queue(channel_name)
+        if queue_name is not None:
+            self.forget(queue_name)
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+    async def publish(self, channel_name: str, message: Message) -> None:
+        """Публикация сообщения канала с ожиданием подтверждения брокера"""
+        route = self.topology.route(channel_name)
+        try:
+            await self._declare(route)
+            await self.transport.publish(route.exchange_name, route.routing_key, message)
+        except Exception:
+            self.forget(route.queue_name)
+            raise
+
+
+class PendingPublish:
+    """Сообщение, ожидающее отправки в составе пакета"""
+    __slots__ = ("route", "message", "future", "enqueued_at")
+
+    def __init__(self, route: Route, message: Message, future: asyncio.Future) -> None:
+        self.route = route
+        self.message = message
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
 
-        connection = await aio_pika.connect_robust(settings.mq_settings.broker_url)
-        async with connection:
-            channel = await connection.channel()
+class BatchingPublisher(Publisher):
+    """Конвейерный издатель
 
-            exchange = await channel.declare_exchange('default', aio_pika.ExchangeType.DIRECT, durable=True)
+    Сообщения, пришедшие в пределах короткого окна, отправляются пакетом без
+    ожидания подтверждений между ними; число неподтвержденных публикаций
+    ограничено окном max_in_flight. Вызывающий по-прежнему ждет подтверждения
+    своего сообщения, но не очереди из чужих round-trip.
+    """
+    def __init__(
+        self,
+        transport: Transport,
+        topology: PerChannelTopology,
+        max_in_flight: int,
+        batch_size: int,
+        batch_window: float,
+        stats_interval: float,
+    ) -> None:
+        super().__init__(transport, topology)
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.stats_interval = stats_interval
+        self._pending: asyncio.Queue = asyncio.Queue()
+        self._window = asyncio.Semaphore(max_in_flight)
+        self._confirms: Set[asyncio.Task] = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self.confirmed = 0
+        self.failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._latency_count = 0
+        self._reported_at = time.monotonic()
 
-            queue = await channel.declare_queue(queue_name, durable=True)
+    async def start(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
 
-            await queue.bind(exchange, routing_key=queue_name)
-            logger.debug(f"Очередь {queue_name} связана с обменником 'default' с routing_key: {queue_name}")
+    async def stop(self) -> None:
+        """Отправка накопленных сообщений и ожидание их подтверждений"""
+        if self._flusher is None:
+            return
 
-            message = Message(
-                body=message_body,
-                delivery_mode=2, 
-                content_type="application/json"
+        await self._pending.join()
+        self._flusher.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._flusher
+        self._flusher = None
+
+        if self._confirms:
+            await asyncio.gather(*self._confirms, return_exceptions=True)
+        self._report()
+
+    def stats(self) -> dict:
+        return {
+            "confirmed": self.confirmed,
+            "failed": self.failed,
+            "pending": self._pending.qsize(),
+            "in_flight": len(self._confirms),
+            "confirm_latency_avg_ms": self._latency_total / self._latency_count * 1000 if self._latency_count else 0.0,
+            "confirm_latency_max_ms": self._latency_max * 1000,
+        }
+
+    async def publish(self, channel_name: str, message: Message) -> None:
+        """Постановка в пакет и ожидание подтверждения брокера"""
+        if self._flusher is None or self._flusher.done():
+            await self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait(PendingPublish(self.topology.route(channel_name), message, future))
+        await future
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._pending.get()]
+            if self._pending.qsize() < self.batch_size - 1 and self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.batch_size and not self._pending.empty():
+                batch.append(self._pending.get_nowait())
+
+            try:
+                await self._dispatch(batch)
+            except Exception as e:
+                logger.error(f"Ошибка пакетной публикации в RabbitMQ: {e}")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+            if time.monotonic() - self._reported_at >= self.stats_interval:
+                self._report()
+
+    async def _dispatch(self, batch: List[PendingPublish]) -> None:
+        for item in batch:
+            if item.future.done():
+                continue
+
+            try:
+                await self._declare(item.route)
+            except Exception as e:
+                self.forget(item.route.queue_name)
+                item.future.set_exception(e)
+                continue
+
+            await self._window.acquire()
+            task = asyncio.create_task(
+                self.transport.publish(item.route.exchange_name, item.route.routing_key, item.message)
             )
+            self._confirms.add(task)
+            task.add_done_callback(partial(self._on_confirm, item))
+
+    def _on_confirm(self, item: PendingPublish, task: asyncio.Task) -> None:
+        self._confirms.discard(task)
+        self._window.release()
+
+        if task.cancelled():
+            if not item.future.done():
+                item.future.cancel()
+            return
+
+        error = task.exception()
+        if error is not None:
+            self.failed += 1
+            self.forget(item.route.queue_name)
+            if not item.future.done():
+                item.future.set_exception(error)
+            return
+
+        latency = time.monotonic() - item.enqueued_at
+        self.confirmed += 1
+        self._latency_total += latency
+        self._latency_count += 1
+        self._latency_max = max(self._latency_max, latency)
+        if not item.future.done():
+            item.future.set_result(None)
+
+    def _report(self) -> None:
+        if self._latency_count:
+            stats = self.stats()
+            logger.info(
+                f"Издатель: подтверждено {stats['confirmed']}, ошибок {stats['failed']}, "
+                f"в полете {stats['in_flight']}, задержка подтверждения "
+                f"средняя {stats['confirm_latency_avg_ms']:.1f} мс, максимальная {stats['confirm_latency_max_ms']:.1f} мс"
+            )
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._latency_count = 0
+        self._reported_at = time.monotonic()
+
+
+def get_publisher() -> Publisher:
+    if settings.mq_settings.publisher_mode == "batched":
+        return BatchingPublisher(
+            transport,
+            topology,
+            max_in_flight=settings.mq_settings.publisher_max_in_flight,
+            batch_size=settings.mq_settings.publisher_batch_size,
+            batch_window=settings.mq_settings.publisher_batch_window_ms / 1000,
+            stats_interval=settings.mq_settings.publisher_stats_interval,
+        )
+    return Publisher(transport, topology)
+
+
+publisher: Publisher = get_publisher()
+
+
+async def publish_message_to_queue(channel_name: str, message_data: dict, numbered: bool = True) -> dict:
+    """Публикация сообщения канала в очередь согласно топологии; возвращает сообщение с номером и id
+
+    Новый номер получают только сообщения (numbered), остальные события - последний номер канала.
+    """
+    try:
+        logger.debug(f"Попытка публикации сообщения канала {channel_name}: {message_data}")
+        if numbered:
+            message_data['sequence_number'] = await next_sequence_number(channel_name)
+        else:
+            message_data['sequence_number'] = await current_sequence_number(channel_name)
+        # id задается до публикации: по нему повторные доставки не дублируются в БД
+        message_data.setdefault('id', str(uuid4()))
+        message_body, content_type = encode_event(message_data, settings.mq_settings.wire_format)
+
+        logger.debug(f"Сериализованное сообщение: {message_body}")
+
+        message = Message(
+            body=message_body,
+            delivery_mode=2, 
+            content_type=content_type
+        )
 
-            await exchange.publish(message, routing_key=queue_name)
-            logger.info(f"Сообщение успешно опубликовано в очередь {queue_name}: {message_data}")
+        await publisher.publish(channel_name, message)
+        logger.debug(f"Сообщение канала {channel_name} успешно опубликовано: {message_data}")
+        return message_data
 
     except Exception as e:
         logger.error(f"Ошибка при публикации сообщения в RabbitMQ: {e}")
         raise e
 
 
-async def send_message_to_queue(channel_name: str, message_data: dict):
+async def send_message_to_queue(channel_name: str, message_data: dict, numbered: bool = True) -> dict:
     """Отправка сообщения в очередь"""
     try:
         logger.debug(f"Сообщение направлено в очередь {channel_name}: {message_data}")
-        await publish_message_to_queue(
-            queue_name=f"{channel_name}_messages", 
-            message_data=message_data
+        return await publish_message_to_queue(
+            channel_name=channel_name,
+            message_data=message_data,
+            numbered=numbered,
         )
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения в очередь: {e}")
@@ -63,19 +368,21 @@ async def send_message_to_queue(channel_name: str, message_data: dict):
 
 async def handle_user_activity(
     action: str, username: str, channel_name: str, current_time: str
-):
+) -> dict:
     """Обработчик действий пользователя в чате"""
     logger.debug(f"Обработка действий пользователя: {action} для пользователя {username} в канале {channel_name} в {current_time}")
-    await send_message_to_queue(
+    return await send_message_to_queue(
         channel_name, 
-        {"action": action, "username": username, "channel": channel_name, "time": current_time}
+        {"action": action, "username": username, "channel": channel_name, "time": current_time},
+        numbered=False,
     )
 
 async def handle_moderator_action(
     action: str, target_username: str, channel_name: str, current_time: str
-):
+) -> dict:
     logger.debug(f"Обработка действий модератора: {action} для пользователя {target_username} в канале {channel_name} в {current_time}")
-    await send_message_to_queue(
+    return await send_message_to_queue(
         channel_name, 
-        {"action": action, "username": target_username, "channel": channel_name, "time": current_time}
+        {"action": action, "username": target_username, "channel": channel_name, "time": current_time},
+        numbered=False,
     )
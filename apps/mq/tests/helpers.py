@@ -0,0 +1,23 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[3]
+
+
+def assert_module_configures_mappers(module: str) -> None:
+    """После импорта одного module связи моделей настраиваются и сообщение создается
+
+    Проверка идет в отдельном интерпретаторе: в процессе тестов модели уже импортированы другими модулями.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", (
+            f"import {module}\n"
+            "from sqlalchemy.orm import configure_mappers\n"
+            "from apps.chats.models.chats import ChatMessageInDB\n"
+            "configure_mappers()\n"
+            "ChatMessageInDB(action='message', username='alice', channel='general', sequence_number=1, message='hi')\n"
+        )],
+        cwd=ROOT, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
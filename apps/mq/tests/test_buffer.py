@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+from apps.mq.buffer import WriteBehindBuffer
+
+
+class FakeWriter:
+    def __init__(self, delay: float = 0, failures: int = 0):
+        self.delay = delay
+        self.failures = failures
+        self.batches = []
+
+    async def __call__(self, messages):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("БД недоступна")
+        self.batches.append([m["seq"] for m in messages])
+
+    @property
+    def written(self):
+        return [seq for batch in self.batches for seq in batch]
+
+
+def make_buffer(writer, **kwargs):
+    options = dict(
+        max_messages=1000, max_bytes=1 << 20, max_age=0.05,
+        min_batch=10, max_batch=1000, target_latency=0.1, retry_delay=0.01,
+    )
+    options.update(kwargs)
+    return WriteBehindBuffer(writer, **options)
+
+
+def message(seq: int, channel: str = "general"):
+    return {"channel": channel, "seq": seq}
+
+
+@pytest.mark.asyncio
+async def test_quiet_channel_is_flushed_by_age():
+    writer = FakeWriter()
+    buffer = make_buffer(writer)
+
+    await buffer.put(message(1), 10)
+    await asyncio.sleep(0.1)
+
+    assert writer.written == [1]
+    assert len(buffer) == 0
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_messages_added_during_flush_are_not_lost():
+    writer = FakeWriter(delay=0.02)
+    buffer = make_buffer(writer)
+
+    for seq in range(10):
+        await buffer.put(message(seq), 10)
+    await asyncio.sleep(0.01)
+    for seq in range(10, 15):
+        await buffer.put(message(seq), 10)
+
+    assert [m["seq"] for m in buffer.pending("general")] == list(range(15))
+
+    await buffer.stop()
+    assert writer.written == list(range(15))
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_retried_in_order():
+    writer = FakeWriter(failures=1)
+    buffer = make_buffer(writer)
+
+    for seq in range(3):
+        await buffer.put(message(seq), 10)
+    await asyncio.sleep(0.15)
+
+    assert writer.written == [0, 1, 2]
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_full_buffer_applies_backpressure():
+    writer = FakeWriter(delay=0.05)
+    buffer = make_buffer(writer, max_messages=5, max_age=1)
+
+    for seq in range(5):
+        await buffer.put(message(seq), 10)
+    blocked = asyncio.create_task(buffer.put(message(5), 10))
+    await asyncio.sleep(0.01)
+
+    assert not blocked.done()
+    await asyncio.wait_for(blocked, timeout=1)
+    await buffer.stop()
+    assert writer.written == list(range(6))
+
+
+@pytest.mark.asyncio
+async def test_batch_size_grows_while_commits_are_fast():
+    writer = FakeWriter()
+    buffer = make_buffer(writer, max_age=1)
+
+    for seq in range(500):
+        await buffer.put(message(seq, channel=f"c{seq % 7}"), 10)
+    await buffer.stop()
+
+    assert buffer.batch_size > 10
+    assert sorted(writer.written) == list(range(500))
+
+
+@pytest.mark.asyncio
+async def test_pending_is_indexed_by_channel_and_sequence():
+    writer = FakeWriter()
+    buffer = make_buffer(writer, max_age=10, min_batch=100)
+
+    for seq in (1, 2, 4, 3, 5):
+        await buffer.put({"channel": "general", "seq": seq, "sequence_number": seq}, 10)
+    await buffer.put({"channel": "random", "seq": 100, "sequence_number": 100}, 10)
+
+    assert [m["seq"] for m in buffer.pending("general")] == [1, 2, 3, 4, 5]
+    assert [m["seq"] for m in buffer.pending("general", limit=2)] == [4, 5]
+    assert [m["seq"] for m in buffer.pending("general", after=(1, float("inf")), limit=2, newest=False)] == [2, 3]
+    assert [m["seq"] for m in buffer.pending("general", before=(4, -1))] == [1, 2, 3]
+
+    await buffer.flush()
+    assert buffer.pending("general") == []
+    assert buffer.pending("random") == []
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_unwritable_message_is_isolated_and_dead_lettered():
+    bad = {13, 42}
+
+    async def writer(messages):
+        if any(m["seq"] in bad for m in messages):
+            raise ValueError("значение слишком длинное для колонки")
+        written.extend(m["seq"] for m in messages)
+
+    written, dead = [], []
+
+    async def on_dead_letter(receipts):
+        dead.extend(receipts)
+
+    buffer = make_buffer(
+        writer, max_age=10, min_batch=64,
+        on_dead_letter=on_dead_letter, is_row_error=lambda error: isinstance(error, ValueError),
+    )
+    for seq in range(64):
+        await buffer.put(message(seq, channel=f"c{seq % 3}"), 10, receipt=seq)
+
+    assert await buffer.flush() == 62
+    assert sorted(written) == sorted(set(range(64)) - bad)
+    assert sorted(dead) == sorted(bad)
+    assert len(buffer) == 0 and buffer.pending("c0") == []
+    assert buffer.stats()["dead_lettered"] == 2
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_database_errors_are_retried_without_splitting():
+    writer = FakeWriter(failures=1)
+    buffer = make_buffer(writer, is_row_error=lambda error: isinstance(error, ValueError))
+
+    for seq in range(4):
+        await buffer.put(message(seq), 10)
+    with pytest.raises(RuntimeError):
+        await buffer.flush()
+    assert len(buffer) == 4
+
+    assert await buffer.flush() == 4
+    assert writer.batches == [[0, 1, 2, 3]]
+    await buffer.stop()
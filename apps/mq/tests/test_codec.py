@@ -0,0 +1,50 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from apps.mq.codec import (COMPACT_CONTENT_TYPE, LEGACY_CONTENT_TYPE,
+                           DecodeError, decode_event, encode_event)
+
+MESSAGE = {
+    "id": "0b8f7c2e-52a4-4c53-9e53-2d7d6f1b7f10",
+    "action": "message",
+    "username": "alice",
+    "channel": "general",
+    "time": "2024-11-20T10:15:30.123000+00:00",
+    "sequence_number": 42,
+    "message": "привет",
+    "created_at": "2024-11-20T10:15:30.123456+00:00",
+    "updated_at": "2024-11-20T10:15:30.123456+00:00",
+}
+
+
+def test_compact_format_round_trip():
+    body, content_type = encode_event(dict(MESSAGE), "compact")
+    decoded = decode_event(body, content_type, "general")
+
+    assert content_type == COMPACT_CONTENT_TYPE
+    assert len(body) < len(json.dumps(MESSAGE, ensure_ascii=False).encode("utf-8")) / 2
+    assert decoded == {
+        "action": "message",
+        "username": "alice",
+        "channel": "general",
+        "time": datetime(2024, 11, 20, 10, 15, 30, 123000, tzinfo=timezone.utc),
+        "sequence_number": 42,
+        "message": "привет",
+        "id": MESSAGE["id"],
+    }
+
+
+def test_legacy_format_is_still_accepted():
+    body, content_type = encode_event(dict(MESSAGE), "json")
+
+    assert content_type == LEGACY_CONTENT_TYPE
+    assert decode_event(body, content_type, "general") == decode_event(*encode_event(dict(MESSAGE), "compact"), "general")
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(DecodeError):
+        decode_event(b"\x00", "application/x-unknown", "general")
+    with pytest.raises(DecodeError):
+        decode_event(b"[2]", COMPACT_CONTENT_TYPE, "general")
@@ -0,0 +1,159 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from aio_pika import Message
+
+from apps.mq import consumer
+from apps.mq.buffer import WriteBehindBuffer
+from apps.mq.codec import encode_event
+from apps.mq.topology import PerChannelTopology
+from apps.mq.transport import InMemoryTransport
+
+
+class FakeWriter:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.unwritable = set()
+        self.written = []
+
+    async def __call__(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("БД недоступна")
+        if any(m["sequence_number"] in self.unwritable for m in messages):
+            raise ValueError("значение слишком длинное для колонки")
+        self.written.extend(m["sequence_number"] for m in messages)
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    transport = InMemoryTransport()
+    writer = FakeWriter()
+    buffer = WriteBehindBuffer(
+        writer, max_messages=1000, max_bytes=1 << 20, max_age=10,
+        min_batch=1000, max_batch=1000, target_latency=1,
+        on_persisted=consumer.acknowledge_persisted,
+        on_dead_letter=consumer.reject_unwritable,
+        is_row_error=consumer.is_row_error,
+    )
+    monkeypatch.setattr(consumer, "transport", transport)
+    monkeypatch.setattr(consumer, "topology", PerChannelTopology())
+    monkeypatch.setattr(consumer, "message_buffer", buffer)
+    monkeypatch.setattr(consumer, "recent_ids", consumer.RecentIds(100))
+    return transport, writer, buffer
+
+
+async def publish(transport, count: int, body: bytes | None = None, message_id: str | None = None):
+    for seq in range(count):
+        data, content_type = encode_event({
+            "action": "message", "username": "alice", "channel": "general",
+            "time": datetime.now(timezone.utc), "sequence_number": seq, "message": "hi", "id": message_id,
+        }, "compact")
+        await transport.publish("default", "general_messages", Message(body=body or data, content_type=content_type))
+
+
+@pytest.mark.asyncio
+async def test_messages_are_acked_only_after_commit(pipeline):
+    transport, writer, buffer = pipeline
+    task = asyncio.create_task(consumer.start_consumer("general_messages", prefetch_count=100))
+    await asyncio.sleep(0.01)
+    await publish(transport, 5)
+    await asyncio.sleep(0.01)
+
+    queue = transport.queues["general_messages"]
+    assert len(queue.consumers[0].unacked) == 5
+
+    writer.failures = 1
+    with pytest.raises(RuntimeError):
+        await buffer.flush()
+    assert len(queue.consumers[0].unacked) == 5
+
+    await buffer.flush()
+    assert writer.written == [0, 1, 2, 3, 4]
+    assert not queue.consumers[0].unacked
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_undecodable_message_does_not_block_acks(pipeline):
+    transport, writer, buffer = pipeline
+    task = asyncio.create_task(consumer.start_consumer("general_messages", prefetch_count=100))
+    await asyncio.sleep(0.01)
+    await publish(transport, 1)
+    await transport.publish("default", "general_messages", Message(body=b"\x00", content_type="application/x-unknown"))
+    await publish(transport, 1)
+    await asyncio.sleep(0.01)
+
+    await buffer.flush()
+    queue = transport.queues["general_messages"]
+    assert not queue.consumers[0].unacked
+    assert not queue.ready
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_redelivery_of_persisted_message_skips_db(pipeline):
+    transport, writer, buffer = pipeline
+    task = asyncio.create_task(consumer.start_consumer("general_messages", prefetch_count=100))
+    await asyncio.sleep(0.01)
+    message_id = "6f1c1a52-6d3e-4f57-9a55-3f0f2a3b8e10"
+    await publish(transport, 1, message_id=message_id)
+    await asyncio.sleep(0.01)
+    await buffer.flush()
+
+    await publish(transport, 1, message_id=message_id)
+    await asyncio.sleep(0.01)
+    await buffer.flush()
+
+    assert writer.written == [0]
+    assert not transport.queues["general_messages"].consumers[0].unacked
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_unwritable_message_is_rejected_and_the_rest_acked(pipeline):
+    transport, writer, buffer = pipeline
+    task = asyncio.create_task(consumer.start_consumer("general_messages", prefetch_count=100))
+    await asyncio.sleep(0.01)
+    writer.unwritable = {2}
+    await publish(transport, 5)
+    await asyncio.sleep(0.01)
+
+    await buffer.flush()
+    queue = transport.queues["general_messages"]
+    assert writer.written == [0, 1, 3, 4]
+    assert not queue.consumers[0].unacked
+    assert not queue.ready
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await buffer.stop()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_shares_do_not_depend_on_start_order(monkeypatch):
+    started = {}
+
+    async def fake_start_consumer(queue_name, prefetch_count=0):
+        started[queue_name] = prefetch_count
+
+    monkeypatch.setattr(consumer, "start_consumer", fake_start_consumer)
+    monkeypatch.setattr(consumer.settings.mq_settings, "consumer_prefetch", None)
+    monkeypatch.setattr(consumer, "topology", PerChannelTopology())
+    registry = consumer.ConsumerRegistry()
+    for i in range(10):
+        registry.acquire_channel(f"channel_{i}")
+    await asyncio.sleep(0)
+
+    assert set(started.values()) == {consumer.settings.mq_settings.flush_batch_min}
+    assert consumer.get_prefetch_count(4) * 4 <= consumer.settings.mq_settings.buffer_max_messages
@@ -0,0 +1,25 @@
+from apps.mq.persistence import is_row_error
+from apps.mq.tests.helpers import assert_module_configures_mappers
+
+
+def test_benchmark_builds_orm_models_on_its_own():
+    assert_module_configures_mappers("benchmark_persistence")
+
+
+class PostgresError(Exception):
+    def __init__(self, sqlstate):
+        self.sqlstate = sqlstate
+
+
+class WrappedError(Exception):
+    def __init__(self, orig):
+        self.orig = orig
+
+
+def test_row_errors_are_told_apart_from_database_errors():
+    assert is_row_error(ValueError("badly formed hexadecimal UUID string"))
+    assert is_row_error(PostgresError("22001"))
+    assert is_row_error(WrappedError(PostgresError("23503")))
+    assert not is_row_error(PostgresError("08006"))
+    assert not is_row_error(WrappedError(PostgresError("42P01")))
+    assert not is_row_error(ConnectionRefusedError())
@@ -0,0 +1,184 @@
+import asyncio
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import pytest
+from aio_pika import Message
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import Session
+
+from apps.chats.models.chats import ChatInDB
+from apps.mq import publisher as publisher_module
+from apps.mq.publisher import BatchingPublisher, Publisher
+from apps.mq.topology import PartitionedTopology, PerChannelTopology
+from apps.mq.transport import InMemoryTransport
+
+
+class SlowTransport(InMemoryTransport):
+    """Брокер в памяти с задержкой подтверждения публикации"""
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+        self.declared = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def declare_queue(self, name, durable=True, arguments=None):
+        self.declared.append(name)
+        await super().declare_queue(name, durable, arguments)
+
+    async def publish(self, exchange_name, routing_key, message):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        await super().publish(exchange_name, routing_key, message)
+
+
+def make_publisher(delay: float, max_in_flight: int = 1000):
+    transport = SlowTransport(delay)
+    publisher = BatchingPublisher(
+        transport,
+        PerChannelTopology(),
+        max_in_flight=max_in_flight,
+        batch_size=100,
+        batch_window=0.001,
+        stats_interval=60,
+    )
+    return publisher, transport
+
+
+@pytest.mark.asyncio
+async def test_publishes_are_pipelined_and_declared_once():
+    publisher, transport = make_publisher(delay=0.05)
+
+    await asyncio.wait_for(
+        asyncio.gather(*(publisher.publish("general", Message(body=str(i).encode())) for i in range(200))),
+        timeout=1,
+    )
+    await publisher.stop()
+
+    assert len(transport.queues["general_messages"].ready) == 200
+    assert transport.max_in_flight > 1
+    assert transport.declared == ["general_messages"]
+    assert publisher.stats()["confirmed"] == 200
+
+
+@pytest.mark.asyncio
+async def test_in_flight_window_is_bounded():
+    publisher, transport = make_publisher(delay=0.01, max_in_flight=5)
+
+    await asyncio.gather(*(publisher.publish("general", Message(body=b"x")) for _ in range(50)))
+    await publisher.stop()
+
+    assert len(transport.queues["general_messages"].ready) == 50
+    assert transport.max_in_flight == 5
+
+
+@pytest.mark.asyncio
+async def test_partitioned_topology_keeps_channel_order_in_one_queue():
+    transport = InMemoryTransport()
+    topology = PartitionedTopology("chat_messages", partitions=4)
+    publisher = Publisher(transport, topology)
+
+    for i in range(10):
+        for channel_name in ("general", "random", "news"):
+            await publisher.publish(channel_name, Message(body=f"{channel_name}:{i}".encode()))
+
+    assert len(transport.queues) <= 4
+    for channel_name in ("general", "random", "news"):
+        queue = transport.queues[topology.route(channel_name).queue_name]
+        bodies = [m.body.decode() for m in queue.ready if m.routing_key.endswith(f".{channel_name}")]
+        assert bodies == [f"{channel_name}:{i}" for i in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_declarations_of_other_queues_do_not_wait_and_are_forgotten():
+    transport = SlowTransport(delay=0)
+    publisher = Publisher(transport, PerChannelTopology())
+    blocked = asyncio.Event()
+    declare_queue = transport.declare_queue
+
+    async def slow_declare(name, durable=True, arguments=None):
+        if name == "slow_messages":
+            await blocked.wait()
+        await declare_queue(name, durable, arguments)
+
+    transport.declare_queue = slow_declare
+    slow = asyncio.create_task(publisher.publish("slow", Message(body=b"x")))
+    await asyncio.sleep(0)
+    await asyncio.wait_for(publisher.publish("fast", Message(body=b"x")), timeout=1)
+    blocked.set()
+    await slow
+
+    publisher.forget_channel("fast")
+    assert list(publisher._declared) == ["slow_messages"]
+    assert not publisher._declare_locks
+
+
+class AsyncSession:
+    def __init__(self, session):
+        self.session = session
+
+    async def execute(self, stmt):
+        return self.session.execute(stmt)
+
+    async def commit(self):
+        self.session.commit()
+
+
+@pytest.mark.asyncio
+async def test_sequence_numbers_come_from_the_chat_counter(monkeypatch):
+    engine = create_engine("sqlite://")
+    event.listen(engine, "connect", lambda connection, _: connection.execute("ATTACH ':memory:' AS public"))
+    with Session(engine) as session:
+        ChatInDB.__table__.create(session.connection())
+        session.execute(ChatInDB.__table__.insert().values(id=uuid4(), name="general", last_sequence_number=41))
+        session.commit()
+
+    @asynccontextmanager
+    async def async_session():
+        with Session(engine) as session:
+            yield AsyncSession(session)
+
+    monkeypatch.setattr(publisher_module, "async_session", async_session)
+    assert [await publisher_module.next_sequence_number("general") for _ in range(3)] == [42, 43, 44]
+    with Session(engine) as session:
+        assert session.execute(select(ChatInDB.__table__.c.last_sequence_number)).scalar() == 44
+    with pytest.raises(ValueError):
+        await publisher_module.next_sequence_number("missing")
+
+
+@pytest.mark.asyncio
+async def test_activity_reuses_last_number_without_locking_the_chat(monkeypatch):
+    engine = create_engine("sqlite://")
+    event.listen(engine, "connect", lambda connection, _: connection.execute("ATTACH ':memory:' AS public"))
+    with Session(engine) as session:
+        ChatInDB.__table__.create(session.connection())
+        session.execute(ChatInDB.__table__.insert().values(id=uuid4(), name="general", last_sequence_number=7))
+        session.commit()
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2].split()[0]))
+
+    @asynccontextmanager
+    async def async_session():
+        with Session(engine) as session:
+            yield AsyncSession(session)
+
+    async def publish(channel_name, message):
+        pass
+
+    monkeypatch.setattr(publisher_module, "async_session", async_session)
+    monkeypatch.setattr(publisher_module.publisher, "publish", publish)
+    monkeypatch.setattr(publisher_module, "last_sequence_numbers", {})
+
+    joined = await publisher_module.handle_user_activity("connect", "alice", "general", "2026-10-18T12:00:00+00:00")
+    message = await publisher_module.send_message_to_queue("general", {
+        "action": "message", "username": "alice", "channel": "general", "time": "2026-10-18T12:01:00+00:00", "message": "hi",
+    })
+    # Сообщение другого процесса пришло из шины рассылки
+    publisher_module.note_sequence_number("general", 9)
+    left = await publisher_module.handle_user_activity("disconnect", "alice", "general", "2026-10-18T12:02:00+00:00")
+
+    assert (joined["sequence_number"], message["sequence_number"], left["sequence_number"]) == (7, 8, 9)
+    assert statements == ["SELECT", "UPDATE"]
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+from aio_pika import Message
+
+from apps.mq.connection import RabbitMQConnectionManager
+from apps.mq.transport import (AioPikaTransport, InMemoryTransport, Transport,
+                               topic_matches)
+
+
+async def make_queue(transport: InMemoryTransport, name: str = "general_messages"):
+    await transport.declare_exchange("default", "direct")
+    await transport.declare_queue(name)
+    await transport.bind(name, "default", routing_key=name)
+
+
+@pytest.mark.asyncio
+async def test_prefetch_limits_unacked_deliveries():
+    transport = InMemoryTransport()
+    await make_queue(transport)
+    received = []
+
+    async def on_message(message):
+        received.append(message)
+
+    await transport.consume("general_messages", on_message, prefetch_count=2)
+    for i in range(5):
+        await transport.publish("default", "general_messages", Message(body=str(i).encode()))
+    await asyncio.sleep(0)
+
+    assert [m.body for m in received] == [b"0", b"1"]
+
+    await received[1].ack(multiple=True)
+    await asyncio.sleep(0)
+
+    assert [m.body for m in received] == [b"0", b"1", b"2", b"3"]
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_processing_is_redelivered():
+    transport = InMemoryTransport()
+    await make_queue(transport)
+    attempts = []
+
+    async def on_message(message):
+        async with message.process(requeue=True):
+            attempts.append((message.body, message.redelivered))
+            if not message.redelivered:
+                raise RuntimeError("сбой обработки")
+
+    await transport.consume("general_messages", on_message)
+    await transport.publish("default", "general_messages", Message(body=b"hello"))
+    await asyncio.sleep(0.01)
+
+    assert attempts == [(b"hello", False), (b"hello", True)]
+    assert not transport.queues["general_messages"].ready
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_cancel_returns_unacked_messages_to_queue():
+    transport = InMemoryTransport()
+    await make_queue(transport)
+
+    async def on_message(message):
+        pass
+
+    consumer_tag = await transport.consume("general_messages", on_message)
+    await transport.publish("default", "general_messages", Message(body=b"hello"))
+    await transport.cancel(consumer_tag)
+
+    ready = transport.queues["general_messages"].ready
+    assert [m.body for m in ready] == [b"hello"]
+    assert ready[0].redelivered
+
+
+def test_topic_matching():
+    assert topic_matches("3.*", "3.general")
+    assert topic_matches("#", "3.general")
+    assert not topic_matches("3.*", "4.general")
+    assert not topic_matches("3.*", "3.general.extra")
+
+
+class FakeExchange:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def publish(self, message, routing_key):
+        self.channel.published.append((routing_key, message.body))
+        self.channel.in_flight += 1
+        FakeChannel.max_in_flight = max(FakeChannel.max_in_flight, sum(c.in_flight for c in FakeChannel.opened))
+        await FakeChannel.confirms.wait()
+        self.channel.in_flight -= 1
+
+
+class FakeChannel:
+    """Канал AMQP: публикация записывается сразу, подтверждение ждет общего события"""
+    opened = []
+    confirms = None
+    max_in_flight = 0
+
+    def __init__(self):
+        self.is_closed = False
+        self.published = []
+        self.in_flight = 0
+        FakeChannel.opened.append(self)
+
+    async def get_exchange(self, name, ensure=False):
+        return FakeExchange(self)
+
+
+class FakeConnection:
+    async def channel(self, publisher_confirms=False):
+        return FakeChannel()
+
+
+@pytest.mark.asyncio
+async def test_aio_pika_publishes_are_pipelined_and_pinned_by_routing_key():
+    FakeChannel.opened, FakeChannel.confirms, FakeChannel.max_in_flight = [], asyncio.Event(), 0
+    manager = RabbitMQConnectionManager("amqp://", channel_pool_size=2)
+    manager.connection = FakeConnection()
+    transport = AioPikaTransport(manager)
+
+    publishes = [
+        asyncio.create_task(transport.publish("default", f"{key}_messages", Message(body=str(i).encode())))
+        for i in range(10) for key in ("general", "random", "news")
+    ]
+    await asyncio.sleep(0.01)
+    assert FakeChannel.max_in_flight == 30
+    FakeChannel.confirms.set()
+    await asyncio.gather(*publishes)
+
+    assert len(FakeChannel.opened) <= 2
+    for key in ("general", "random", "news"):
+        channels = [c for c in FakeChannel.opened if any(rk == f"{key}_messages" for rk, _ in c.published)]
+        assert len(channels) == 1
+        assert [body for rk, body in channels[0].published if rk == f"{key}_messages"] == [
+            str(i).encode() for i in range(10)
+        ]
+
+
+def test_incomplete_transport_fails_on_instantiation():
+    class PublishOnlyTransport(Transport):
+        async def publish(self, exchange_name, routing_key, message):
+            pass
+
+    with pytest.raises(TypeError):
+        PublishOnlyTransport()
@@ -0,0 +1,5 @@
+from apps.mq.tests.helpers import assert_module_configures_mappers
+
+
+def test_worker_process_configures_mappers():
+    assert_module_configures_mappers("apps.mq.worker")
@@ -0,0 +1,94 @@
+import zlib
+from typing import Dict, List, Optional
+
+from apps.core.config import settings
+from apps.mq.connection import get_queue_arguments
+from apps.mq.transport import Transport
+
+
+class Route:
+    """Куда публикуется сообщение канала"""
+    __slots__ = ("exchange_name", "routing_key", "queue_name")
+
+    def __init__(self, exchange_name: str, routing_key: str, queue_name: str) -> None:
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.queue_name = queue_name
+
+
+class PerChannelTopology:
+    """Отдельная очередь {channel}_messages на каждый канал за direct-обменником
+
+    Потребитель очереди запускается, пока в канале есть участники.
+    """
+    exchange_name = "default"
+    exchange_type = "direct"
+
+    def route(self, channel_name: str) -> Route:
+        queue_name = f"{channel_name}_messages"
+        return Route(self.exchange_name, queue_name, queue_name)
+
+    def channel_name(self, routing_key: str) -> str:
+        """Канал сообщения по ключу маршрутизации"""
+        return routing_key.removesuffix("_messages")
+
+    def consumer_queue(self, channel_name: str) -> Optional[str]:
+        """Очередь, потребитель которой нужен на время активности канала"""
+        return f"{channel_name}_messages"
+
+    def partition_queues(self, workers: int = 1, index: int = 0) -> List[str]:
+        """Очереди с постоянными потребителями, доставшиеся воркеру index из workers"""
+        return []
+
+    async def declare_queue(self, transport: Transport, queue_name: str) -> None:
+        await transport.declare_exchange(self.exchange_name, self.exchange_type, durable=True)
+        await transport.declare_queue(queue_name, durable=True, arguments=get_queue_arguments())
+        await transport.bind(queue_name, self.exchange_name, routing_key=queue_name)
+
+
+class PartitionedTopology(PerChannelTopology):
+    """Фиксированный набор очередей-партиций за topic-обменником
+
+    Ключ маршрутизации - "{партиция}.{канал}", партиция - crc32 имени канала по модулю
+    числа партиций, поэтому все сообщения канала идут через одну очередь и сохраняют порядок.
+    """
+    exchange_type = "topic"
+
+    def __init__(self, exchange_name: str, partitions: int) -> None:
+        self.exchange_name = exchange_name
+        self.partitions = partitions
+        self._queues: Dict[str, int] = {self.queue_name(p): p for p in range(partitions)}
+
+    def partition(self, channel_name: str) -> int:
+        return zlib.crc32(channel_name.encode("utf-8")) % self.partitions
+
+    def queue_name(self, partition: int) -> str:
+        return f"{self.exchange_name}.{partition}"
+
+    def route(self, channel_name: str) -> Route:
+        partition = self.partition(channel_name)
+        return Route(self.exchange_name, f"{partition}.{channel_name}", self.queue_name(partition))
+
+    def channel_name(self, routing_key: str) -> str:
+        return routing_key.split(".", 1)[1]
+
+    def consumer_queue(self, channel_name: str) -> Optional[str]:
+        return None
+
+    def partition_queues(self, workers: int = 1, index: int = 0) -> List[str]:
+        return [self.queue_name(p) for p in range(self.partitions) if p % workers == index]
+
+    async def declare_queue(self, transport: Transport, queue_name: str) -> None:
+        partition = self._queues[queue_name]
+        await transport.declare_exchange(self.exchange_name, self.exchange_type, durable=True)
+        await transport.declare_queue(queue_name, durable=True)
+        await transport.bind(queue_name, self.exchange_name, routing_key=f"{partition}.#")
+
+
+def get_topology() -> PerChannelTopology:
+    if settings.mq_settings.topology == "partitioned":
+        return PartitionedTopology(settings.mq_settings.topic_exchange, settings.mq_settings.partitions)
+    return PerChannelTopology()
+
+
+topology: PerChannelTopology = get_topology()
@@ -0,0 +1,356 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from itertools import count
+from typing import (Any, AsyncIterator, Awaitable, Callable, Deque, Dict,
+                    List, Optional, Set, Tuple)
+
+import aio_pika
+from aio_pika import Message
+from aio_pika.abc import AbstractChannel
+
+from apps.core.config import settings
+from apps.mq.connection import (RabbitMQConnectionManager,
+                                rabbit_connection_manager)
+
+logger = logging.getLogger(__name__)
+
+MessageCallback = Callable[[Any], Awaitable[Any]]
+
+
+class TransportError(Exception):
+    """Ошибка брокера: неизвестный обменник, очередь или потребитель"""
+
+
+class Transport(ABC):
+    """Операции с брокером, которые нужны издателю и потребителям"""
+    @abstractmethod
+    async def connect(self) -> None:
+        ...
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+    @abstractmethod
+    async def declare_exchange(self, name: str, type: str = "direct", durable: bool = True) -> None:
+        ...
+
+    @abstractmethod
+    async def declare_queue(self, name: str, durable: bool = True, arguments: Optional[dict] = None) -> None:
+        ...
+
+    @abstractmethod
+    async def bind(self, queue_name: str, exchange_name: str, routing_key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def publish(self, exchange_name: str, routing_key: str, message: Message) -> None:
+        """Публикация; возвращает управление после подтверждения брокера"""
+
+    @abstractmethod
+    async def consume(self, queue_name: str, callback: MessageCallback, prefetch_count: int = 0) -> str:
+        """Подписка на очередь с ручным подтверждением; возвращает тег потребителя"""
+
+    @abstractmethod
+    async def cancel(self, consumer_tag: str) -> None:
+        """Отписка; неподтвержденные сообщения возвращаются в очередь"""
+
+
+class AioPikaTransport(Transport):
+    """Транспорт поверх RabbitMQ: объявления через пул каналов, публикации через каналы,
+    закрепленные за ключом маршрутизации, отдельный канал на потребителя"""
+    def __init__(self, connection_manager: RabbitMQConnectionManager) -> None:
+        self.connection_manager = connection_manager
+        self._consumers: Dict[str, AbstractChannel] = {}
+
+    async def connect(self) -> None:
+        await self.connection_manager.connect()
+
+    async def close(self) -> None:
+        self._consumers.clear()
+        await self.connection_manager.disconnect()
+
+    async def declare_exchange(self, name: str, type: str = "direct", durable: bool = True) -> None:
+        async with self.connection_manager.acquire_channel() as channel:
+            await channel.declare_exchange(name, aio_pika.ExchangeType(type), durable=durable)
+
+    async def declare_queue(self, name: str, durable: bool = True, arguments: Optional[dict] = None) -> None:
+        async with self.connection_manager.acquire_channel() as channel:
+            await channel.declare_queue(name, durable=durable, arguments=arguments)
+
+    async def bind(self, queue_name: str, exchange_name: str, routing_key: str) -> None:
+        async with self.connection_manager.acquire_channel() as channel:
+            queue = await channel.get_queue(queue_name, ensure=False)
+            await queue.bind(exchange_name, routing_key=routing_key)
+
+    async def publish(self, exchange_name: str, routing_key: str, message: Message) -> None:
+        # Ключ маршрутизации однозначно задает канал чата: его сообщения идут одним каналом
+        # AMQP по порядку, а ожидание подтверждения не занимает канал для остальных публикаций
+        channel = await self.connection_manager.publish_channel(routing_key)
+        exchange = await channel.get_exchange(exchange_name, ensure=False)
+        await exchange.publish(message, routing_key=routing_key)
+
+    async def consume(self, queue_name: str, callback: MessageCallback, prefetch_count: int = 0) -> str:
+        await self.connect()
+        channel = await self.connection_manager.connection.channel()
+        if prefetch_count:
+            await channel.set_qos(prefetch_count=prefetch_count)
+        queue = await channel.get_queue(queue_name, ensure=False)
+        consumer_tag = await queue.consume(callback, no_ack=False)
+        self._consumers[consumer_tag] = channel
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str) -> None:
+        channel = self._consumers.pop(consumer_tag, None)
+        if channel is not None and not channel.is_closed:
+            await channel.close()
+
+
+class InMemoryMessage:
+    """Доставленное сообщение с интерфейсом подтверждений как у aio_pika.IncomingMessage"""
+    __slots__ = (
+        "body", "content_type", "headers", "delivery_mode", "exchange",
+        "routing_key", "delivery_tag", "redelivered", "_consumer", "_processed",
+    )
+
+    def __init__(self, message: Message, exchange: str, routing_key: str) -> None:
+        self.body = message.body
+        self.content_type = message.content_type
+        self.headers = dict(message.headers or {})
+        self.delivery_mode = message.delivery_mode
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.delivery_tag: Optional[int] = None
+        self.redelivered = False
+        self._consumer: Optional["InMemoryConsumer"] = None
+        self._processed = False
+
+    @property
+    def processed(self) -> bool:
+        return self._processed
+
+    async def ack(self, multiple: bool = False) -> None:
+        self._consumer.settle(self.delivery_tag, multiple, requeue=None)
+
+    async def nack(self, multiple: bool = False, requeue: bool = True) -> None:
+        self._consumer.settle(self.delivery_tag, multiple, requeue=requeue)
+
+    async def reject(self, requeue: bool = False) -> None:
+        self._consumer.settle(self.delivery_tag, False, requeue=requeue)
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False, ignore_processed: bool = False) -> AsyncIterator["InMemoryMessage"]:
+        try:
+            yield self
+            if not ignore_processed and not self._processed:
+                await self.ack()
+        except BaseException:
+            if not ignore_processed and not self._processed:
+                await self.reject(requeue=requeue)
+            raise
+
+
+class InMemoryQueue:
+    """Очередь брокера в памяти процесса"""
+    def __init__(self, name: str, broker: "InMemoryTransport") -> None:
+        self.name = name
+        self.broker = broker
+        self.ready: Deque[InMemoryMessage] = deque()
+        self.consumers: List["InMemoryConsumer"] = []
+        self._next_consumer = 0
+
+    def put(self, message: InMemoryMessage, front: bool = False) -> None:
+        message._consumer = None
+        message.delivery_tag = None
+        message._processed = False
+        if front:
+            self.ready.appendleft(message)
+        else:
+            self.ready.append(message)
+
+    def dispatch(self) -> None:
+        """Раздача готовых сообщений потребителям по кругу с учетом prefetch"""
+        while self.ready and self.consumers:
+            for _ in range(len(self.consumers)):
+                consumer = self.consumers[self._next_consumer % len(self.consumers)]
+                self._next_consumer += 1
+                if consumer.has_capacity:
+                    consumer.deliver(self.ready.popleft())
+                    break
+            else:
+                return
+
+
+class InMemoryConsumer:
+    """Потребитель очереди: свои теги доставки и неподтвержденные сообщения"""
+    def __init__(self, tag: str, queue: InMemoryQueue, callback: MessageCallback, prefetch_count: int) -> None:
+        self.tag = tag
+        self.queue = queue
+        self.callback = callback
+        self.prefetch_count = prefetch_count
+        self.unacked: "OrderedDict[int, InMemoryMessage]" = OrderedDict()
+        self._delivery_tags = count(1)
+
+    @property
+    def has_capacity(self) -> bool:
+        return not self.prefetch_count or len(self.unacked) < self.prefetch_count
+
+    def deliver(self, message: InMemoryMessage) -> None:
+        message.delivery_tag = next(self._delivery_tags)
+        message._consumer = self
+        self.unacked[message.delivery_tag] = message
+        self.queue.broker.spawn(self.callback(message))
+
+    def settle(self, delivery_tag: int, multiple: bool, requeue: Optional[bool]) -> None:
+        """Подтверждение (requeue=None) или отказ с возвратом в очередь либо без него"""
+        if delivery_tag not in self.unacked:
+            raise TransportError(f"Неизвестный тег доставки {delivery_tag}")
+
+        if multiple:
+            tags = [tag for tag in self.unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag]
+
+        requeued = []
+        for tag in tags:
+            message = self.unacked.pop(tag)
+            message._processed = True
+            if requeue:
+                requeued.append(message)
+
+        for message in reversed(requeued):
+            message.redelivered = True
+            self.queue.put(message, front=True)
+        self.queue.dispatch()
+
+    def requeue_unacked(self) -> None:
+        for message in reversed(list(self.unacked.values())):
+            message.redelivered = True
+            self.queue.put(message, front=True)
+        self.unacked.clear()
+
+
+class InMemoryTransport(Transport):
+    """Брокер в памяти процесса с семантикой AMQP: обменники direct/topic/fanout,
+    подтверждения, prefetch и повторная доставка. Нужен для тестов и нагрузочных
+    прогонов без RabbitMQ; сообщения не переживают перезапуск процесса.
+    """
+    def __init__(self) -> None:
+        self.exchanges: Dict[str, str] = {"": "direct"}
+        self.bindings: Dict[str, Set[Tuple[str, str]]] = {"": set()}
+        self.queues: Dict[str, InMemoryQueue] = {}
+        self._consumers: Dict[str, InMemoryConsumer] = {}
+        self._consumer_tags = count(1)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        for consumer_tag in list(self._consumers):
+            await self.cancel(consumer_tag)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def declare_exchange(self, name: str, type: str = "direct", durable: bool = True) -> None:
+        existing = self.exchanges.get(name)
+        if existing is not None and existing != type:
+            raise TransportError(f"Обменник {name} уже объявлен с типом {existing}")
+        self.exchanges[name] = type
+        self.bindings.setdefault(name, set())
+
+    async def declare_queue(self, name: str, durable: bool = True, arguments: Optional[dict] = None) -> None:
+        if name not in self.queues:
+            self.queues[name] = InMemoryQueue(name, self)
+
+    async def bind(self, queue_name: str, exchange_name: str, routing_key: str) -> None:
+        self._get_queue(queue_name)
+        if exchange_name not in self.exchanges:
+            raise TransportError(f"Обменник {exchange_name} не объявлен")
+        self.bindings[exchange_name].add((routing_key, queue_name))
+
+    async def publish(self, exchange_name: str, routing_key: str, message: Message) -> None:
+        for queue_name in self.route(exchange_name, routing_key):
+            queue = self.queues[queue_name]
+            queue.put(InMemoryMessage(message, exchange_name, routing_key))
+            queue.dispatch()
+
+    async def consume(self, queue_name: str, callback: MessageCallback, prefetch_count: int = 0) -> str:
+        queue = self._get_queue(queue_name)
+        consumer_tag = f"memory.{next(self._consumer_tags)}"
+        consumer = InMemoryConsumer(consumer_tag, queue, callback, prefetch_count)
+        self._consumers[consumer_tag] = consumer
+        queue.consumers.append(consumer)
+        queue.dispatch()
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str) -> None:
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is None:
+            return
+        consumer.queue.consumers.remove(consumer)
+        consumer.requeue_unacked()
+        consumer.queue.dispatch()
+
+    def route(self, exchange_name: str, routing_key: str) -> List[str]:
+        """Очереди, в которые попадет сообщение; неадресуемое сообщение отбрасывается"""
+        exchange_type = self.exchanges.get(exchange_name)
+        if exchange_type is None:
+            raise TransportError(f"Обменник {exchange_name} не объявлен")
+
+        if exchange_name == "":
+            return [routing_key] if routing_key in self.queues else []
+
+        queues = []
+        for binding_key, queue_name in self.bindings[exchange_name]:
+            if exchange_type == "fanout" or (
+                exchange_type == "topic" and topic_matches(binding_key, routing_key)
+            ) or (exchange_type == "direct" and binding_key == routing_key):
+                if queue_name not in queues:
+                    queues.append(queue_name)
+        return queues
+
+    def spawn(self, coroutine: Awaitable[Any]) -> None:
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка обработчика сообщения: {task.exception()}")
+
+    def _get_queue(self, queue_name: str) -> InMemoryQueue:
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            raise TransportError(f"Очередь {queue_name} не объявлена")
+        return queue
+
+
+def topic_matches(binding_key: str, routing_key: str) -> bool:
+    """Сопоставление ключа маршрутизации с шаблоном topic-обменника (* - одно слово, # - любое число слов)"""
+    pattern = binding_key.split(".")
+    words = routing_key.split(".")
+
+    def match(i: int, j: int) -> bool:
+        if i == len(pattern):
+            return j == len(words)
+        if pattern[i] == "#":
+            return any(match(i + 1, k) for k in range(j, len(words) + 1))
+        if j == len(words):
+            return False
+        return (pattern[i] == "*" or pattern[i] == words[j]) and match(i + 1, j + 1)
+
+    return match(0, 0)
+
+
+def get_transport() -> Transport:
+    if settings.mq_settings.transport == "memory":
+        return InMemoryTransport()
+    return AioPikaTransport(rabbit_connection_manager)
+
+
+transport: Transport = get_transport()
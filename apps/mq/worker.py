@@ -0,0 +1,104 @@
+"""Отдельный процесс сохранения сообщений из очередей в БД
+
+Запуск: python -m apps.mq.worker --workers 4 [--index 0]
+
+Воркер с номером index из workers потребляет партиции p, для которых
+p % workers == index, поэтому у каждой партиции (а значит и у каждого канала)
+ровно один потребитель и порядок сообщений канала сохраняется. Без --index
+запускаются все workers процессов сразу. Требует MQ_TOPOLOGY=partitioned;
+веб-процессы при этом запускаются с MQ_INGEST_IN_WEB=false.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from logging import config as logging_config
+from typing import List
+
+from apps.core.config import settings
+from apps.core.logger import get_logging_config
+from apps.mq.consumer import ConsumerRegistry, ingest_stats
+from apps.mq.topology import PartitionedTopology, topology
+from apps.mq.transport import transport
+
+logger = logging.getLogger(__name__)
+
+
+async def report_stats(interval: float) -> None:
+    """Периодический вывод пропускной способности воркера"""
+    received, persisted, started_at = ingest_stats.received, ingest_stats.persisted, time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        elapsed = now - started_at
+        logger.info(
+            f"Воркер: принято {ingest_stats.received - received} ({(ingest_stats.received - received) / elapsed:.1f}/с), "
+            f"сохранено {ingest_stats.persisted - persisted} ({(ingest_stats.persisted - persisted) / elapsed:.1f}/с), "
+            f"всего ошибок сохранения {ingest_stats.failed}, повторных доставок {ingest_stats.duplicates}, "
+            f"отклонено незаписываемых {ingest_stats.dead_lettered}"
+        )
+        received, persisted, started_at = ingest_stats.received, ingest_stats.persisted, now
+
+
+async def run_worker(workers: int, index: int, stats_interval: float) -> None:
+    registry = ConsumerRegistry()
+    await transport.connect()
+    queue_names = registry.start_partitions(workers, index)
+    logger.info(f"Воркер {index + 1}/{workers} запущен, очереди: {', '.join(queue_names) or 'нет'}")
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+
+    reporter = asyncio.create_task(report_stats(stats_interval))
+    try:
+        await stopped.wait()
+    finally:
+        reporter.cancel()
+        await registry.stop()
+        await transport.close()
+        logger.info(f"Воркер {index + 1}/{workers} остановлен")
+
+
+def run_process(workers: int, index: int, stats_interval: float) -> None:
+    logging_config.dictConfig(get_logging_config(log_level=settings.chats_settings.log_level or "INFO"))
+    asyncio.run(run_worker(workers, index, stats_interval))
+
+
+def main(argv: List[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Сохранение сообщений чатов из RabbitMQ в БД")
+    parser.add_argument("--workers", type=int, default=1, help="общее число воркеров")
+    parser.add_argument("--index", type=int, default=None, help="номер этого воркера; без него запускаются все")
+    parser.add_argument("--stats-interval", type=float, default=settings.mq_settings.worker_stats_interval)
+    args = parser.parse_args(argv)
+
+    if not isinstance(topology, PartitionedTopology):
+        parser.error("Отдельный воркер работает только с MQ_TOPOLOGY=partitioned")
+    if args.workers < 1 or args.workers > topology.partitions:
+        parser.error(f"--workers должно быть от 1 до числа партиций ({topology.partitions})")
+    if args.index is not None and not 0 <= args.index < args.workers:
+        parser.error("--index должен быть от 0 до workers - 1")
+
+    if args.index is not None or args.workers == 1:
+        run_process(args.workers, args.index or 0, args.stats_interval)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_process, args=(args.workers, index, args.stats_interval), name=f"worker-{index}")
+        for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    # Ctrl+C получает вся группа процессов, воркеры останавливаются сами; SIGTERM пересылается им
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: [process.terminate() for process in processes])
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
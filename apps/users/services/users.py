@@ -69,9 +69,11 @@ class Service:
                 detail="Внутренняя ошибка сервера. Пожалуйста, попробуйте снова"
             )
         
-    async def get_user_by_id(self, user_id: UUID) -> UserInDB:
+    async def get_user_by_id(self, user_id: UUID, with_chats: bool = True) -> UserInDB:
         """Получение пользователя по id"""
-        query = select(UserInDB).options(selectinload(UserInDB.chats))
+        query = select(UserInDB)
+        if with_chats:
+            query = query.options(selectinload(UserInDB.chats))
         user = await self.session.execute(query.filter(UserInDB.id == user_id))
         user = user.scalars().first()
         if not user:
@@ -0,0 +1,71 @@
+"""Сравнение способов записи пакетов сообщений в chat_messages
+
+Запуск: python benchmark_persistence.py --messages 100000 --batch 1000 --modes orm insert copy
+
+Пишет в каналы с префиксом bench_ и удаляет их после прогона. Время процессора
+(process_time) показывает нагрузку на само приложение, без ожидания БД.
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import List
+
+from sqlalchemy import delete
+
+from apps.chats.models.chats import ChatMessageInDB
+from apps.db import engine
+from apps.mq.persistence import BATCH_WRITERS
+
+
+def generate_messages(count: int, channels: int) -> List[dict]:
+    """Сообщения в том виде, в каком их отдает decode_event"""
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            "action": "message",
+            "username": f"user_{i % 500}",
+            "channel": f"bench_{i % channels}",
+            "time": now,
+            "sequence_number": i,
+            "message": f"Тестовое сообщение номер {i}",
+            "id": None,
+        }
+        for i in range(count)
+    ]
+
+
+async def cleanup() -> None:
+    async with engine.begin() as connection:
+        await connection.execute(delete(ChatMessageInDB.__table__).where(ChatMessageInDB.channel.like("bench\\_%")))
+
+
+async def run_mode(mode: str, messages: List[dict], batch_size: int) -> None:
+    writer = BATCH_WRITERS[mode]
+    started_wall, started_cpu = time.perf_counter(), time.process_time()
+    for start in range(0, len(messages), batch_size):
+        await writer(messages[start:start + batch_size])
+    wall, cpu = time.perf_counter() - started_wall, time.process_time() - started_cpu
+
+    print(
+        f"{mode:>6}: {len(messages)} сообщений за {wall:.2f} с "
+        f"({len(messages) / wall:,.0f}/с), процессор приложения {cpu:.2f} с"
+    )
+    await cleanup()
+
+
+async def run(args: argparse.Namespace) -> None:
+    messages = generate_messages(args.messages, args.channels)
+    await cleanup()
+    for mode in args.modes:
+        await run_mode(mode, messages, args.batch)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--channels", type=int, default=100)
+    parser.add_argument("--modes", nargs="+", choices=list(BATCH_WRITERS), default=list(BATCH_WRITERS))
+    asyncio.run(run(parser.parse_args()))
@@ -1,3 +1,5 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from http import HTTPStatus
 from logging import config as logging_config
 from typing import Any, AsyncGenerator
@@ -10,10 +12,14 @@ from uvicorn import run
 
 from apps.auth.api.v1.api import auth_routers as v1_auth_routers
 from apps.chats.api.v1.api import chats_routers as v1_chats_routers
+from apps.chats.services.realtime import run_channel_reaper
 from apps.core.config import settings
 from apps.core.logger import get_logging_config
 from apps.core.setup import setup_docs, setup_router
-from apps.mq.connection import RabbitMQConnectionManager
+from apps.mq.consumer import consumer_registry
+from apps.mq.fanout import fanout_bus
+from apps.mq.publisher import publisher
+from apps.mq.transport import transport
 from apps.users.api.v1.api import users_routers as v1_users_routers
 
 IS_DEBUG: bool = settings.chats_settings.is_debug or False
@@ -48,11 +54,33 @@ async def unicorn_exception_handler(
             "detail": detail,
         },
     )
-rabbit_connection_manager = RabbitMQConnectionManager(settings.mq_settings.broker_url)
+
 
 def get_application() -> FastAPI:
     project_name: str = settings.chats_settings.docs_name.replace("-", " ").capitalize()
 
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncGenerator:
+        print("Запуск приложения...")
+        await transport.connect()
+        print("Соединение с RabbitMQ установлено.")
+        await publisher.start()
+        consumer_registry.start_partitions()
+        await fanout_bus.start()
+        channel_reaper = asyncio.create_task(run_channel_reaper())
+
+        yield
+
+        print("Остановка приложения...")
+        channel_reaper.cancel()
+        with suppress(asyncio.CancelledError):
+            await channel_reaper
+        await consumer_registry.stop()
+        await fanout_bus.stop()
+        await publisher.stop()
+        await transport.close()
+        print("Соединение с RabbitMQ закрыто.")
+
     app: FastAPI = FastAPI(
         title=project_name,
         default_response_class=ORJSONResponse,
@@ -60,6 +88,7 @@ def get_application() -> FastAPI:
         docs_url=None,
         openapi_url=None,
         debug=IS_DEBUG,
+        lifespan=lifespan,
     )
 
     app.add_exception_handler(
@@ -67,19 +96,6 @@ def get_application() -> FastAPI:
         handler=unicorn_exception_handler,
     )
 
-    rabbit_connection_manager = RabbitMQConnectionManager(settings.mq_settings.broker_url)
-
-    async def lifespan(app: FastAPI) -> AsyncGenerator:
-        print("Запуск приложения...")
-        await rabbit_connection_manager.connect()
-        print("Соединение с RabbitMQ установлено.")
-
-        yield
-
-        print("Остановка приложения...")
-        await rabbit_connection_manager.disconnect()
-        print("Соединение с RabbitMQ закрыто.")
-
     setup_docs(
         app=app,
         version="v1",